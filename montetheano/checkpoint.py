@@ -0,0 +1,123 @@
+"""
+Checkpoint and restore of the state of a running chain.
+
+The state of a chain is the value of every shared variable its compiled
+functions update (the free RV states, the log likelihood, the RandomStates of
+the RandomStreams), plus the state of numpy.random, which some samplers draw
+from directly.  A Checkpointer snapshots all of it in the calling thread and
+pickles the snapshot to disk from a background thread, writing to a temporary
+file that is renamed over the checkpoint so a crash never leaves a torn file.
+
+To resume a preempted run, rebuild the same model and sampler, then
+
+    cp = Checkpointer(filename, sampler)
+    store = TraceStore(directory)
+    if cp.exists():
+        info = cp.restore()
+        store.truncate(info['n_draws'])
+    sampler(nr_samples - len(store), burnin=0, store=store, checkpoint=cp)
+
+The continuation is bit-identical to an uninterrupted run with the same
+chunk size.
+"""
+import os
+import cPickle
+import threading
+import numpy
+from rstreams import randomstate_types
+
+
+def chain_state(sampler):
+    """
+    Return the shared variables holding the state of `sampler`: those in
+    `sampler.state` and `sampler.rstates`, and those that the functions in
+    `sampler.functions` update or draw from.  The order is deterministic for
+    a given sampler.
+    """
+    rval = list(getattr(sampler, 'state', [])) + list(getattr(sampler, 'rstates', []))
+    for f in getattr(sampler, 'functions', []):
+        for i in f.maker.inputs:
+            v = i.variable
+            if not hasattr(v, 'get_value') or v in rval:
+                continue
+            if i.update is not None or isinstance(v.type, randomstate_types):
+                rval.append(v)
+    return rval
+
+
+class Checkpointer(object):
+    """
+    Save and restore the state of a chain in `filename`.
+
+    `variables` defaults to chain_state(sampler).
+    """
+    def __init__(self, filename, sampler = None, variables = None):
+        if variables is None:
+            variables = chain_state(sampler)
+        self.filename = filename
+        self.variables = list(variables)
+        self.thread = None
+        self.error = None
+
+    def snapshot(self, **info):
+        return dict(info=info,
+                values=[v.get_value(borrow=False) for v in self.variables],
+                numpy_random=numpy.random.get_state())
+
+    def _write(self, snapshot):
+        try:
+            tmp = self.filename + '.tmp'
+            f = open(tmp, 'wb')
+            try:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except Exception, e:
+            self.error = e
+
+    def save(self, **info):
+        """
+        Snapshot the state now and write it in the background.
+
+        Keyword arguments are stored with the state and returned by restore.
+        """
+        snapshot = self.snapshot(**info)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(snapshot,))
+        self.thread.start()
+
+    def wait(self):
+        """
+        Block until the last checkpoint is on disk.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def restore(self):
+        """
+        Load the last checkpoint into the variables and numpy.random, and
+        return the keyword arguments it was saved with.
+        """
+        self.wait()
+        f = open(self.filename, 'rb')
+        try:
+            snapshot = cPickle.load(f)
+        finally:
+            f.close()
+        if len(snapshot['values']) != len(self.variables):
+            raise ValueError('checkpoint does not match the chain',
+                    len(snapshot['values']), len(self.variables))
+        for v, value in zip(self.variables, snapshot['values']):
+            v.set_value(value, borrow=True)
+        numpy.random.set_state(snapshot['numpy_random'])
+        return snapshot['info']
@@ -0,0 +1,222 @@
+"""
+Compiling the theano functions of a sampler, with an optional on-disk cache.
+
+A sampler declares its functions with CompiledFunctions.function, which
+returns a placeholder to call later, and compiles them all at once with
+compile().  With a `cache_dir` the compiled functions are pickled there,
+under a structural hash of all their graphs (see for_theano.structural_hash).
+A later process that builds the same model loads them instead of compiling
+-- unpickled theano functions are not optimized again -- and links them again
+against the shared variables of its own model (free RV states, RandomStates,
+...), which keep their current values.
+
+Along with the functions the cache stores their shared-state layout -- which
+shared variable each function reads, by position and type -- and the values
+of the RandomStates.  With `restore_rng` a loaded sampler also takes those
+RandomStates; save() writes the current ones.  The state of the chain itself
+is not cached; to resume a chain see checkpoint.Checkpointer.
+"""
+import os
+import cPickle
+import hashlib
+import theano
+from theano.tensor.raw_random import RandomStateType
+from theano.compile.pfunc import rebuild_collect_shared
+from for_theano import structural_hash
+
+
+class _Placeholder(object):
+    # stands for a function of a CompiledFunctions until it is compiled
+    def __init__(self):
+        self.fn = None
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # maker, input_storage, ... of the compiled function
+        if name == 'fn':
+            raise AttributeError(name)
+        return getattr(self.fn, name)
+
+
+def _pairs(d):
+    # the items of the updates or givens `d`, in an order that does not
+    # depend on the process, or None if some items can't be told apart
+    if not d:
+        return []
+    if hasattr(d, 'items'):
+        d = d.items()
+    keyed = [(structural_hash([k, v]), k, v) for k, v in d]
+    keyed.sort(key=lambda x: x[0])
+    hashes = [h for h, k, v in keyed]
+    if len(set(hashes)) < len(hashes):
+        return None
+    return [(k, v) for h, k, v in keyed]
+
+def _shared_inputs(inputs, outputs, updates, givens):
+    # the shared variables of a function, in the order theano.function
+    # appends them to its inputs
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    return rebuild_collect_shared(list(outputs), list(inputs), replace=givens,
+            updates=updates, rebuild_strict=True, copy_inputs_over=True)[2][3]
+
+
+class CompiledFunctions(object):
+    """
+    The theano functions of a sampler, compiled together and, with
+    `cache_dir`, cached on disk.
+    """
+    def __init__(self, cache_dir = None, restore_rng = False):
+        self.cache_dir = cache_dir
+        self.restore_rng = restore_rng
+        self.specs = []
+        self.functions = None
+        self.filename = None
+        self.loaded = False
+        self.rng_states = None
+
+    def function(self, inputs, outputs, updates = None, givens = None, **kwargs):
+        """
+        Declare theano.function(inputs, outputs, updates, givens, **kwargs)
+        and return a placeholder that calls it once compile() has run.
+        """
+        p = _Placeholder()
+        self.specs.append((inputs, outputs, updates, givens, kwargs, p))
+        return p
+
+    def key(self):
+        """
+        Return the structural hash of all the functions, or None if they
+        can't be cached.
+        """
+        parts = [theano.__version__, theano.config.floatX]
+        for inputs, outputs, updates, givens, kwargs, p in self.specs:
+            updates, givens = _pairs(updates), _pairs(givens)
+            if updates is None or givens is None:
+                return None
+            if isinstance(outputs, (list, tuple)):
+                outs = list(outputs)
+                parts.append('list')
+            else:
+                outs = [outputs]
+            parts.append(structural_hash(list(inputs) + outs
+                    + [k for k, v in updates] + [v for k, v in updates],
+                    dict(givens)))
+            parts.append(repr(sorted(kwargs.items())))
+        return hashlib.sha1(' '.join(parts)).hexdigest()
+
+    def _compile(self):
+        rval = []
+        for inputs, outputs, updates, givens, kwargs, p in self.specs:
+            updates, givens = _pairs(updates) or updates, _pairs(givens) or givens
+            rval.append(theano.function(inputs, outputs, updates=updates,
+                givens=givens, **kwargs))
+        return rval
+
+    def _layout(self):
+        # the shared variables of all the functions, in order of first use,
+        # and for every function the positions of its own among them
+        shared = []
+        layout = []
+        for inputs, outputs, updates, givens, kwargs, p in self.specs:
+            positions = []
+            for sv in _shared_inputs(inputs, outputs, _pairs(updates) or updates,
+                    _pairs(givens) or givens):
+                if sv not in shared:
+                    shared.append(sv)
+                positions.append(shared.index(sv))
+            layout.append(positions)
+        return shared, layout
+
+    def _load(self, filename):
+        f = open(filename, 'rb')
+        try:
+            entry = cPickle.load(f)
+        finally:
+            f.close()
+        functions = entry['functions']
+        shared, layout = self._layout()
+        if (len(functions) != len(self.specs) or layout != entry['layout']
+                or [str(sv.type) for sv in shared] != entry['types']):
+            return None
+
+        # rebind the shared variables of the unpickled functions to ours
+        rval = []
+        for fn, (inputs, outputs, updates, givens, kwargs, p), positions in \
+                zip(functions, self.specs, layout):
+            n = len(inputs)
+            if len(fn.maker.inputs) != n + len(positions):
+                return None
+            # the In of every shared input takes our shared variable and its
+            # container, from which the linked function reads and writes
+            for i, k in zip(fn.maker.inputs[n:], positions):
+                i.variable = shared[k]
+                i.value = shared[k].container
+            rval.append(fn.maker.create([i.value for i in fn.maker.inputs]))
+
+        self.rng_states = entry['rng_states']
+        if self.restore_rng:
+            for k, value in self.rng_states.items():
+                shared[k].set_value(value)
+        return rval
+
+    def _rng_states(self, shared):
+        # position -> value of every RandomState among `shared`
+        return dict([(k, sv.get_value()) for k, sv in enumerate(shared)
+            if isinstance(sv.type, RandomStateType)])
+
+    def save(self):
+        """
+        Write the compiled functions, their shared-state layout and the
+        current values of their RandomStates to the cache.
+        """
+        if self.filename is None:
+            return
+        shared, layout = self._layout()
+        entry = dict(functions=self.functions, layout=layout,
+                types=[str(sv.type) for sv in shared],
+                rng_states=self._rng_states(shared))
+        tmp = '%s.%i.tmp' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except Exception:
+            # some op can't be pickled: leave the cache alone
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def compile(self):
+        """
+        Compile (or load) every declared function and return them, in the
+        order they were declared.
+        """
+        key = None
+        if self.cache_dir is not None:
+            key = self.key()
+        filename = None
+        functions = None
+        if key is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            filename = os.path.join(self.cache_dir, key + '.pkl')
+            if os.path.exists(filename):
+                try:
+                    functions = self._load(filename)
+                except Exception:
+                    functions = None
+        self.filename = filename
+        self.loaded = functions is not None
+        if functions is None:
+            functions = self._compile()
+        for fn, spec in zip(functions, self.specs):
+            spec[-1].fn = fn
+        self.functions = functions
+        if not self.loaded:
+            self.save()
+        return functions
@@ -0,0 +1,327 @@
+"""
+Registry of conjugate prior/likelihood pairs, for exact Gibbs updates.
+
+A free random variable can be redrawn from its full conditional when every
+one of its children is a registered conjugate likelihood for its prior.
+Each registered pair provides
+
+    match(rv, child) - the position, among child.owner.inputs, of the
+        parameter through which `child` depends on `rv` in the conjugate way,
+        or None
+    stats(rv, child, given) - the sufficient statistics `child` contributes
+        to the posterior of `rv`, as a tuple of expressions.
+
+and each prior a posterior(s_rng, rv, stats, given) that draws from the
+full conditional given the summed statistics.  `given(expr)` returns `expr`
+with every random variable replaced by its current value.
+
+Where the prior can be integrated out altogether, a rewrite of the model
+removes it instead: see collapse_dirichlet_multinomial.
+"""
+import numpy
+import theano
+from theano import tensor
+from for_theano import infer_shape, ancestors, clone_keep_replacements
+from rstreams import rv_dist_name
+from rv import is_raw_rv
+
+conjugate_likelihoods = {}
+conjugate_posteriors = {}
+
+
+def register_conjugate(prior, likelihood, match, stats):
+    if (prior, likelihood) in conjugate_likelihoods:
+        raise KeyError(prior, likelihood)
+    conjugate_likelihoods[(prior, likelihood)] = (match, stats)
+
+def register_posterior(prior, f):
+    if prior in conjugate_posteriors:
+        raise KeyError(prior)
+    conjugate_posteriors[prior] = f
+    return f
+
+
+def conjugate_update(rv, children, RVs):
+    """
+    Return a function update(s_rng, given) drawing `rv` from its full
+    conditional, or None if `rv` and its `children` (among the random
+    variables `RVs`) are not a conjugate family.
+    """
+    prior = rv_dist_name(rv)
+    if prior not in conjugate_posteriors or not children:
+        return None
+    blockers = set(RVs)
+    handlers = []
+    for child in children:
+        key = (prior, rv_dist_name(child))
+        if key not in conjugate_likelihoods:
+            return None
+        match, stats = conjugate_likelihoods[key]
+        position = match(rv, child)
+        if position is None:
+            return None
+        # no other parameter of the child may depend on rv
+        others = [v for i, v in enumerate(child.owner.inputs) if i != position]
+        if rv in ancestors(others, blockers=blockers):
+            return None
+        handlers.append((child, stats))
+
+    def update(s_rng, given):
+        total = None
+        for child, stats in handlers:
+            s = stats(rv, child, given)
+            if total is None:
+                total = list(s)
+            else:
+                total = [t + si for t, si in zip(total, s)]
+        return tensor.cast(conjugate_posteriors[prior](s_rng, rv, total, given), rv.dtype)
+    return update
+
+
+def _is_constant(v, value):
+    try:
+        return tensor.get_scalar_constant_value(v) == value
+    except tensor.NotScalarConstantError:
+        return False
+
+def _scalar_op(v):
+    if v.owner and isinstance(v.owner.op, tensor.Elemwise):
+        return v.owner.op.scalar_op
+    return None
+
+def _reduce_to(rv, child, x):
+    # sum `x`, shaped like `child`, down to the shape of `rv`: elementwise
+    # when the shapes agree, or over everything for a single-element `rv`
+    if rv.ndim > 0 and infer_shape(rv) == infer_shape(child):
+        return x
+    return tensor.sum(x) + tensor.zeros_like(rv)
+
+def _draw_shape(rv):
+    # the draw shape of `rv`, as a tuple of the right length
+    shape = rv.owner.inputs[1]
+    return tuple([shape[i] for i in range(rv.ndim)])
+
+def _elementwise_child(rv, child):
+    if rv.ndim == 0:
+        return True
+    return infer_shape(rv) == infer_shape(child) or int(numpy.prod(infer_shape(rv))) == 1
+
+
+# ---------
+# Dirichlet
+# ---------
+
+def dirichlet_posterior(s_rng, rv, stats, given):
+    r, shape, alpha = rv.owner.inputs
+    counts, = stats
+    alpha = given(alpha)
+    return s_rng.dirichlet(alpha + tensor.cast(counts, alpha.dtype))
+register_posterior('dirichlet', dirichlet_posterior)
+
+def _dirichlet_1d(rv):
+    return rv.ndim == 1
+
+def dirichlet_categorical_match(rv, child):
+    s_rstate, p, draw_shape = child.owner.inputs
+    if _dirichlet_1d(rv) and p is rv:
+        return 1
+
+def dirichlet_categorical_stats(rv, child, given):
+    x = given(child).flatten()
+    K = rv.shape[0]
+    return (tensor.sum(tensor.eq(x.dimshuffle(0, 'x'), tensor.arange(K)), axis=0),)
+register_conjugate('dirichlet', 'categorical',
+        dirichlet_categorical_match, dirichlet_categorical_stats)
+
+def dirichlet_multinomial_match(rv, child):
+    r, shape, n, p = child.owner.inputs
+    if _dirichlet_1d(rv) and p is rv:
+        return 3
+
+def dirichlet_multinomial_stats(rv, child, given):
+    x = given(child)
+    return (x.reshape((-1, rv.shape[0])).sum(axis=0),)
+register_conjugate('dirichlet', 'multinomial',
+        dirichlet_multinomial_match, dirichlet_multinomial_stats)
+
+def _binomial_index(rv, p):
+    # the constant i of p = rv[i], or None
+    if not (p.owner and isinstance(p.owner.op, tensor.Subtensor)
+            and p.owner.inputs[0] is rv and len(p.owner.inputs) == 2):
+        return None
+    try:
+        return int(tensor.get_scalar_constant_value(p.owner.inputs[1]))
+    except tensor.NotScalarConstantError:
+        return None
+
+def dirichlet_binomial_match(rv, child):
+    # a two-component dirichlet, i.e. a beta, on the p of a binomial
+    r, shape, n, p = child.owner.inputs
+    alpha = rv.owner.inputs[2]
+    if _dirichlet_1d(rv) and alpha.ndim == 1 and infer_shape(alpha) == (2,) and \
+            _binomial_index(rv, p) in (0, 1):
+        return 3
+
+def dirichlet_binomial_stats(rv, child, given):
+    r, shape, n, p = child.owner.inputs
+    x = given(child)
+    successes = tensor.sum(x)
+    failures = tensor.sum(given(n) + tensor.zeros_like(x)) - successes
+    if _binomial_index(rv, p) == 0:
+        return (tensor.stack(successes, failures),)
+    return (tensor.stack(failures, successes),)
+register_conjugate('dirichlet', 'binomial',
+        dirichlet_binomial_match, dirichlet_binomial_stats)
+
+
+# ------
+# Normal
+# ------
+
+def normal_posterior(s_rng, rv, stats, given):
+    r, shape, mu, sigma = rv.owner.inputs
+    precision, weighted = stats
+    mu, sigma = given(mu), given(sigma)
+    precision = precision + 1. / sigma ** 2
+    mean = (weighted + mu / sigma ** 2) / precision
+    return s_rng.normal(mean, 1. / tensor.sqrt(precision), draw_shape=_draw_shape(rv))
+register_posterior('normal', normal_posterior)
+
+def normal_normal_match(rv, child):
+    r, shape, mu, sigma = child.owner.inputs
+    if mu is rv and _elementwise_child(rv, child):
+        return 2
+
+def normal_normal_stats(rv, child, given):
+    r, shape, mu, sigma = child.owner.inputs
+    x, sigma = given(child), given(sigma)
+    precision = 1. / sigma ** 2 + tensor.zeros_like(x)
+    return (_reduce_to(rv, child, precision), _reduce_to(rv, child, x * precision))
+register_conjugate('normal', 'normal', normal_normal_match, normal_normal_stats)
+
+
+# -----
+# Gamma
+# -----
+
+def gamma_posterior(s_rng, rv, stats, given):
+    r, shape, k, theta = rv.owner.inputs
+    n, ss = stats
+    k, theta = given(k), given(theta)
+    return s_rng.gamma(k + n / 2., 1. / (1. / theta + ss / 2.), draw_shape=_draw_shape(rv))
+register_posterior('gamma', gamma_posterior)
+
+def _is_inv_sqrt_of(sigma, rv):
+    # sigma is 1/sqrt(rv), inv(sqrt(rv)) or rv**-0.5
+    op = _scalar_op(sigma)
+    if op is None:
+        return False
+    inputs = sigma.owner.inputs
+    def is_sqrt_rv(v):
+        return isinstance(_scalar_op(v), theano.scalar.Sqrt) and v.owner.inputs[0] is rv
+    if isinstance(op, theano.scalar.TrueDiv):
+        return _is_constant(inputs[0], 1) and is_sqrt_rv(inputs[1])
+    if isinstance(op, theano.scalar.Inv):
+        return is_sqrt_rv(inputs[0])
+    if isinstance(op, theano.scalar.Pow):
+        return inputs[0] is rv and _is_constant(inputs[1], -0.5)
+    return False
+
+def gamma_normal_match(rv, child):
+    # a gamma prior on the precision of a normal
+    r, shape, mu, sigma = child.owner.inputs
+    if _is_inv_sqrt_of(sigma, rv) and _elementwise_child(rv, child):
+        return 3
+
+def gamma_normal_stats(rv, child, given):
+    r, shape, mu, sigma = child.owner.inputs
+    x, mu = given(child), given(mu)
+    return (_reduce_to(rv, child, tensor.ones_like(x)), _reduce_to(rv, child, (x - mu) ** 2))
+register_conjugate('gamma', 'normal', gamma_normal_match, gamma_normal_stats)
+
+
+# ---------------------
+# Collapsed dirichlets
+# ---------------------
+
+_multinomial_names = ('multinomial', 'multinomial_helper')
+
+def _replace(outputs, replacements, RVs):
+    # clone `outputs` with `replacements`, keeping every other one of `RVs`
+    replacements = dict(replacements)
+    for v in RVs:
+        replacements.setdefault(v, v)
+    frontier = [r for r in ancestors(outputs, blockers=replacements.keys())
+            if r.owner is None or r in replacements]
+    return clone_keep_replacements(frontier, outputs, replacements=replacements)[1]
+
+def _collapsible(rv, RVs, all_vars, outputs):
+    # a 1-d dirichlet used only as the p of multinomials
+    if rv_dist_name(rv) != 'dirichlet' or not _dirichlet_1d(rv) or rv in outputs:
+        return None
+    children = []
+    for v in all_vars:
+        if v.owner is None or rv not in v.owner.inputs:
+            continue
+        if v not in RVs or rv_dist_name(v) not in _multinomial_names:
+            return None
+        r, shape, n, p = v.owner.inputs
+        if p is not rv or rv in (r, shape, n):
+            return None
+        children.append(v)
+    if not children:
+        return None
+    # parents first, should one child's n or shape depend on another
+    rval = []
+    while children:
+        for c in children:
+            if not [o for o in children
+                    if o is not c and o in ancestors(c.owner.inputs[1:3])]:
+                break
+        children.remove(c)
+        rval.append(c)
+    return rval
+
+def collapse_dirichlet_multinomial(s_rng, outputs, observations={}):
+    """
+    Integrate out every dirichlet RV that is only used as the `p` of
+    multinomial RVs.
+
+    The multinomials c1, c2, ... of such a dirichlet are replaced by DM
+    (dirichlet-multinomial) RVs: c1 ~ DM(alpha) and each following ck ~
+    DM(alpha + the counts of c1 ... ck-1), which is their exact marginal.
+    Samplers built on the new model never draw the dirichlet; its posterior
+    given the counts is still the conjugate dirichlet update.
+
+    Return the new outputs and observations, and a dict mapping every
+    collapsed dirichlet to its list of replaced children.
+    """
+    outputs = list(outputs)
+    all_vars = ancestors(list(observations.keys()) + outputs)
+    RVs = [v for v in all_vars if is_raw_rv(v)]
+    replacements = {}
+    collapsed = {}
+    for rv in RVs:
+        if rv in observations:
+            continue
+        children = _collapsible(rv, RVs, all_vars, outputs)
+        if children is None:
+            continue
+        alpha = rv.owner.inputs[2]
+        kept = [v for v in RVs if v is not rv and v not in children]
+        for c in children:
+            r, shape, n, p = _replace(c.owner.inputs, replacements, kept)
+            new = s_rng.DM(alpha, n=n, draw_shape=shape, ndim=c.ndim - 1, dtype=c.dtype)
+            replacements[c] = new
+            alpha = alpha + tensor.cast(
+                    new.reshape((-1, new.shape[new.ndim - 1])).sum(axis=0), alpha.dtype)
+        collapsed[rv] = children
+    if not replacements:
+        return outputs, dict(observations), collapsed
+
+    RVs = [v for v in RVs if v not in collapsed and v not in replacements]
+    new_outputs = _replace(outputs, replacements, RVs)
+    new_observations = {}
+    for o, value in observations.items():
+        new_observations[replacements.get(o, o)] = value
+    return new_outputs, new_observations, collapsed
@@ -0,0 +1,207 @@
+"""
+Convergence diagnostics computed while sampling.
+
+A ChainMonitor is handed every chunk of draws as it is produced (see the
+`monitor` argument of the samplers in sample.py).  It keeps running means and
+variances of every chain, and a sliding window of the most recent draws from
+which split R-hat and the effective sample size are computed on demand.
+"""
+import numpy
+
+
+class RunningMoments(object):
+    """
+    Elementwise running mean and variance of a stream of draws.
+
+    Batches are folded in with the pairwise update of Chan et al., so the
+    result matches a two-pass computation over all the draws; two
+    RunningMoments can be merged the same way.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def merge(self, count, mean, m2):
+        if count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, numpy.array(mean, dtype='float64'), \
+                    numpy.array(m2, dtype='float64')
+            return self
+        n = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(count) / n)
+        self.m2 = self.m2 + m2 + delta ** 2 * (float(self.count) * count / n)
+        self.count = n
+        return self
+
+    def update(self, draws):
+        """
+        Fold in `draws`, an array with the draws along its first axis.
+        """
+        draws = numpy.asarray(draws, dtype='float64')
+        if len(draws) == 0:
+            return self
+        mean = draws.mean(axis=0)
+        return self.merge(len(draws), mean, ((draws - mean) ** 2).sum(axis=0))
+
+    def __iadd__(self, other):
+        return self.merge(other.count, other.mean, other.m2)
+
+    def variance(self, ddof = 1):
+        return self.m2 / (self.count - ddof)
+
+
+class _Window(object):
+    # ring buffer of the last `size` draws of one chain
+    def __init__(self, size):
+        self.size = size
+        self.buf = None
+        self.pos = 0
+        self.full = False
+
+    def update(self, draws):
+        draws = numpy.asarray(draws, dtype='float64')[-self.size:]
+        if self.buf is None:
+            self.buf = numpy.empty((self.size,) + draws.shape[1:])
+        n = len(draws)
+        end = self.pos + n
+        if end <= self.size:
+            self.buf[self.pos:end] = draws
+        else:
+            k = self.size - self.pos
+            self.buf[self.pos:] = draws[:k]
+            self.buf[:n - k] = draws[k:]
+        if end >= self.size:
+            self.full = True
+        self.pos = end % self.size
+
+    def get(self):
+        if not self.full:
+            return self.buf[:self.pos]
+        return numpy.concatenate([self.buf[self.pos:], self.buf[:self.pos]])
+
+
+def autocovariance(x):
+    """
+    Autocovariance of `x` along its first axis, by FFT.
+    """
+    x = numpy.asarray(x, dtype='float64')
+    n = len(x)
+    size = 1
+    while size < 2 * n:
+        size *= 2
+    f = numpy.fft.rfft(x - x.mean(axis=0), n=size, axis=0)
+    return numpy.fft.irfft(f * numpy.conjugate(f), n=size, axis=0)[:n].real / n
+
+def split_rhat(chains):
+    """
+    Split R-hat of `chains`, an array (n_chains, n_draws, ...).
+    """
+    chains = numpy.asarray(chains, dtype='float64')
+    half = chains.shape[1] // 2
+    halves = numpy.concatenate([chains[:, :half], chains[:, half:2 * half]])
+    n = halves.shape[1]
+    B = n * halves.mean(axis=1).var(axis=0, ddof=1)
+    W = halves.var(axis=1, ddof=1).mean(axis=0)
+    var_plus = (n - 1.) / n * W + B / n
+    return numpy.sqrt(var_plus / W)
+
+def ess(chains):
+    """
+    Effective sample size of `chains`, an array (n_chains, n_draws, ...),
+    using Geyer's initial monotone sequence estimator.
+
+    An element that is constant over all the draws has nothing left to
+    estimate: its ESS is the number of draws.
+    """
+    chains = numpy.asarray(chains, dtype='float64')
+    m, n = chains.shape[:2]
+    shape = chains.shape[2:]
+    chains = chains.reshape((m, n, -1))
+    acov = numpy.asarray([autocovariance(c) for c in chains])
+    W = chains.var(axis=1, ddof=1).mean(axis=0)
+    var_plus = W * (n - 1.) / n
+    if m > 1:
+        var_plus = var_plus + chains.mean(axis=1).var(axis=0, ddof=1)
+    constant = var_plus == 0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rho = 1. - (W - acov.mean(axis=0)) / var_plus
+    rval = numpy.empty(rho.shape[1])
+    for k in range(rho.shape[1]):
+        if constant[k]:
+            rval[k] = m * n
+            continue
+        tau = -1.
+        prev = numpy.inf
+        for t in range(0, n - 1, 2):
+            p = rho[t, k] + rho[t + 1, k]
+            if not p > 0:
+                break
+            prev = min(prev, p)
+            tau += 2 * prev
+        rval[k] = m * n / max(tau, 1. / numpy.log10(m * n + 10))
+    return rval.reshape(shape)
+
+
+class ChainMonitor(object):
+    """
+    Running moments and diagnostics of one or more chains.
+
+    update(chunk, chain) takes a list with one array of draws per output, the
+    draws along the first axis.  mean, variance, rhat and ess return a list
+    with one array per output.  R-hat and ESS are computed from the last
+    `window` draws of every chain; the ESS is scaled up to all the draws seen
+    so far.
+    """
+    def __init__(self, window = 1000):
+        self.window = window
+        self.moments = {}
+        self.windows = {}
+
+    def update(self, chunk, chain = 0):
+        if chain not in self.moments:
+            self.moments[chain] = [RunningMoments() for c in chunk]
+            self.windows[chain] = [_Window(self.window) for c in chunk]
+        for moments, window, draws in zip(self.moments[chain], self.windows[chain], chunk):
+            moments.update(draws)
+            window.update(draws)
+
+    def count(self):
+        """Draws seen so far, summed over chains."""
+        return sum([m[0].count for m in self.moments.values()])
+
+    def _merged(self):
+        rval = None
+        for chain in sorted(self.moments):
+            if rval is None:
+                rval = [RunningMoments() for m in self.moments[chain]]
+            for r, m in zip(rval, self.moments[chain]):
+                r += m
+        return rval
+
+    def mean(self):
+        return [m.mean for m in self._merged()]
+
+    def variance(self):
+        return [m.variance() for m in self._merged()]
+
+    def _windows(self, k):
+        chains = [self.windows[c][k].get() for c in sorted(self.windows)]
+        n = min([len(c) for c in chains])
+        return numpy.asarray([c[len(c) - n:] for c in chains])
+
+    def _n_outputs(self):
+        return len(self.moments[min(self.moments)])
+
+    def rhat(self):
+        return [split_rhat(self._windows(k)) for k in range(self._n_outputs())]
+
+    def ess(self):
+        rval = []
+        for k in range(self._n_outputs()):
+            chains = self._windows(k)
+            seen = sum([self.moments[c][k].count for c in self.moments])
+            rval.append(ess(chains) * (float(seen) / (chains.shape[0] * chains.shape[1])))
+        return rval
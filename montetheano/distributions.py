@@ -13,8 +13,9 @@ import theano
 import scipy
 import scipy.special
 from theano import tensor
+from theano.tensor.xlogx import xlogy0
 from for_theano import elemwise_cond, ancestors, infer_shape, evaluate
-from rstreams import rng_register, rv_dist_name
+from rstreams import rng_register, rv_dist_name, adaptive_proposal
 
 
 # TODOs:
@@ -100,6 +101,20 @@ def uniform_params(node):
     rstate, shape, low, high = node.inputs
     return [low, high]
 
+@rng_register
+def uniform_proposal(rstream, node, sample, kw):
+    # random walk reflected at the bounds, which keeps it symmetric
+    rstate, shape, low, high = node.inputs
+    width = high - low
+    step = proposal_scale(rstream, node, kw) * width
+    y = sample - low + step * rstream.normal(0, 1, draw_shape = tensor.shape(sample))
+    r = y - 2 * width * tensor.floor(y / (2 * width))
+    return tensor.cast(low + width - abs(r - width), sample.dtype)
+
+@rng_register
+def uniform_proposal_lpdf(rstream, node, proposal, sample, center, kw):
+    return tensor.zeros_like(sample)
+
 def uniform_get_low(v):
     # look in uniform_sampler to see the positions of these things
     if rv_dist_name(v) == 'uniform':
@@ -179,10 +194,37 @@ def normal_params(node):
     rstate, shape, mu, sigma = node.inputs
     return [mu, sigma]
 
+def proposal_scale(rstream, node, kw):
+    """
+    Return the width of a random-walk proposal for node.outputs[1]:
+    kw['scale'] (0.1 by default), or the adapted scale of its AdaptiveProposal
+    in kw['adaptive'], the dict of them that belongs to the sampler (see
+    rstreams).
+    """
+    scale = kw.get('scale', 0.1)
+    if kw.get('adaptive') is not None:
+        return tensor.exp(adaptive_proposal(kw['adaptive'], node.outputs[1],
+            scale=scale).log_scale)
+    return scale
+
 @rng_register
 def normal_proposal(rstream, node, sample, kw):
-    # TODO: how do we determine the variance?
-    return rstream.normal(sample, 0.1, draw_shape = infer_shape(node.outputs[1]))
+    # kw['scale'] sets the width of the random walk; with kw['adaptive'] it
+    # is only the initial width of an AdaptiveProposal (see rstreams)
+    scale = kw.get('scale', 0.1)
+    if kw.get('adaptive') is not None:
+        proposal = adaptive_proposal(kw['adaptive'], node.outputs[1], scale=scale,
+                covariance=kw.get('covariance', False))
+        return proposal.proposal(rstream, sample)
+    return rstream.normal(sample, scale, draw_shape = tensor.shape(sample))
+
+@rng_register
+def normal_proposal_lpdf(rstream, node, proposal, sample, center, kw):
+    if kw.get('adaptive') is not None and kw.get('covariance'):
+        # symmetric random walk: the proposal densities cancel in the
+        # Hastings ratio
+        return tensor.zeros_like(sample)
+    return rstream.pdf(proposal, sample)
 
 
 # ---------
@@ -204,17 +246,36 @@ def binomial_sampler(rstream, n=1, p=0.5, ndim=0, draw_shape=None, dtype=theano.
 @rng_register
 def binomial_lpdf(node, x, kw):
     random_state, size, n, p = node.inputs
-
-    # for the n > 1 the "choose" operation is required
-    # TODO assert n == 1
-    
-    return tensor.switch(tensor.eq(x, 1.), tensor.log(p), tensor.log(1. - p))
+    # log of n choose x, which is 0 for n == 1
+    log_choose = tensor.gammaln(n + 1.) - tensor.gammaln(x + 1.) - tensor.gammaln(n - x + 1.)
+    return log_choose + xlogy0(x, p) + xlogy0(n - x, 1. - p)
 
 @rng_register
 def binomial_params(node):
     rstate, shape, n, p = node.inputs
     return [n, p]
 
+@rng_register
+def binomial_proposal(rstream, node, sample, kw):
+    # every element moves with probability 1/2, to a neighbour x-1 or x+1,
+    # turning back at 0 and n; for n == 1 a move is a flip
+    rstate, shape, n, p = node.inputs
+    draw_shape = tensor.shape(sample)
+    move = rstream.random_integers(0, 1, draw_shape = draw_shape)
+    d = (2 * rstream.random_integers(0, 1, draw_shape = draw_shape) - 1) * move
+    y = sample + d
+    y = tensor.switch(tensor.or_(tensor.lt(y, 0), tensor.gt(y, n)), sample - d, y)
+    return tensor.cast(y, sample.dtype)
+
+@rng_register
+def binomial_proposal_lpdf(rstream, node, proposal, sample, center, kw):
+    # from 0 or n there is only one neighbour to move to; the probability
+    # of moving at all is the same both ways and cancels
+    rstate, shape, n, p = node.inputs
+    return tensor.switch(tensor.and_(tensor.neq(sample, center),
+                tensor.and_(tensor.gt(center, 0), tensor.lt(center, n))),
+            numpy.log(0.5), 0.) + tensor.zeros_like(sample)
+
 
 # ---------
 # Lognormal
@@ -486,7 +547,19 @@ def categorical_lpdf(node, sample, kw):
     """
     # WARNING: I think the p[-1] is not used, but assumed to be p[:-1].sum()
     s_rstate, p, draw_shape = node.inputs
-    return p[sample]
+    return tensor.log(p[sample])
+
+@rng_register
+def categorical_proposal(rstream, node, sample, kw):
+    # move to one of the other K-1 categories, uniformly
+    s_rstate, p, draw_shape = node.inputs
+    K = p.shape[0]
+    offset = rstream.random_integers(1, K - 1, draw_shape = tensor.shape(sample))
+    return tensor.cast((sample + offset) % K, sample.dtype)
+
+@rng_register
+def categorical_proposal_lpdf(rstream, node, proposal, sample, center, kw):
+    return tensor.zeros_like(sample)
 
 
 # ---------
@@ -574,6 +647,16 @@ def dirichlet_lpdf(node, sample, kw):
     ll = -logBeta(alpha) + tensor.sum(tensor.log(sample)*(alpha-1.), axis=0)    
     return tensor.switch(stable, ll, tensor.as_tensor_variable(float('-inf')))
 
+@rng_register
+def dirichlet_proposal(rstream, node, sample, kw):
+    # Dir(c * x) around the current point x; the proposal is a dirichlet RV
+    # itself so its density comes from dirichlet_lpdf.  Several draws at once
+    # (ndim > 1) fall back to the prior.
+    if sample.ndim > 1:
+        return node.outputs[1]
+    c = kw.get('concentration', 100.)
+    return rstream.dirichlet(tensor.maximum(c * sample, 1e-6))
+
 # ---------
 # Gamma
 # ---------
@@ -600,6 +683,13 @@ def gamma_lpdf(node, x, kw):
 
     return tensor.log(x)*(k-1.) - x/theta - tensor.log(theta)*k - logGamma(k)
 
+@rng_register
+def gamma_proposal(rstream, node, sample, kw):
+    # log-normal random walk, a lognormal RV itself, so its density comes
+    # from lognormal_lpdf
+    return rstream.lognormal(tensor.log(sample), proposal_scale(rstream, node, kw),
+            draw_shape = tensor.shape(sample))
+
 # ---------
 # Multinomial
 # ---------
@@ -643,8 +733,9 @@ def multinomial_helper_lpdf(*args, **kwargs):
 # --------------------------------------------------
 # Dirichlet-Multinomial
 #
-# Only the LPDF is implemented, the sampler is bogus. Could be use as an optimization to remove
-# a dirichlet-multinomial to a single op
+# Counts drawn from multinomials that share one dirichlet-distributed p, with
+# p integrated out.  conjugacy.collapse_dirichlet_multinomial rewrites a
+# dirichlet feeding a multinomial into this op.
 # ---------
 
 class DM(theano.Op):
@@ -652,28 +743,64 @@ class DM(theano.Op):
     def __init__(self, otype):
         self.otype = otype
 
-    def make_node(self, s_rstate, alpha):
+    def __eq__(self, other):
+        return type(self) == type(other) and self.otype == other.otype
+
+    def __hash__(self):
+        return hash((type(self), self.otype))
+
+    def make_node(self, s_rstate, alpha, n, draw_shape):
         alpha = tensor.as_tensor_variable(alpha)
+        n = tensor.as_tensor_variable(n)
+        draw_shape = tensor.as_tensor_variable(draw_shape)
         return theano.gof.Apply(self,
-                [s_rstate, alpha],
+                [s_rstate, alpha, n, draw_shape],
                 [s_rstate.type(), self.otype()])
 
     def perform(self, node, inputs, output_storage):
-        raise NotImplemented
+        rng, alpha, n, shp = inputs
+        rng = copy.deepcopy(rng)
+        # one p for all the draws
+        p = rng.dirichlet(alpha)
+        shp = tuple(shp)
+        n = numpy.asarray(n)
+        if n.ndim == 0:
+            rval = rng.multinomial(int(n), p, size=shp)
+        else:
+            n = n + numpy.zeros(shp, dtype=n.dtype)
+            rval = numpy.empty(shp + (len(p),))
+            for idx in numpy.ndindex(*shp):
+                rval[idx] = rng.multinomial(int(n[idx]), p)
+        output_storage[0][0] = rng
+        output_storage[1][0] = self.otype.filter(rval, allow_downcast=True)
+
+    def infer_shape(self, node, ishapes):
+        rstate, alpha, n, shp = node.inputs
+        return [None, [shp[i] for i in range(self.otype.ndim - 1)] + [alpha.shape[0]]]
 
 @rng_register
-def DM_sampler(rstream, alpha, draw_shape=None, ndim=None, dtype=None):
-    shape = infer_shape(rstream.dirichlet(alpha, draw_shape=draw_shape))
+def DM_sampler(rstream, alpha, n=1, draw_shape=None, ndim=None, dtype=theano.config.floatX):
+    alpha = tensor.as_tensor_variable(alpha)
+    if alpha.ndim != 1:
+        raise NotImplementedError()
+    if ndim is None:
+        ndim = tensor.get_vector_length(draw_shape)
     rstate = rstream.new_shared_rstate()
-    op = DM(tensor.TensorType(broadcastable=(False,)* tensor.get_vector_length(shape), dtype=theano.config.floatX))
-    rs, out = op(rstate, alpha)
+    op = DM(tensor.TensorType(broadcastable=(False,) * (ndim + 1), dtype=dtype))
+    rs, out = op(rstate, alpha, n, draw_shape)
     rstream.add_default_update(out, rstate, rs)
     return out
 
 @rng_register
 def DM_lpdf(node, sample, kw):
-    r, alpha = node.inputs
-    return logBeta(sample + alpha) - logBeta(alpha)
+    # the multinomial coefficients of all the draws, and the dirichlet
+    # integral over the pooled counts
+    r, alpha, n, shape = node.inputs
+    counts = tensor.as_tensor_variable(sample).astype(theano.config.floatX)
+    counts = counts.reshape((-1, alpha.shape[0]))
+    n = counts.sum(axis=1)
+    coef = tensor.sum(logFactorial(n)) - tensor.sum(logFactorial(counts))
+    return coef + logBeta(alpha + counts.sum(axis=0)) - logBeta(alpha)
 
 
 # --------------------------------
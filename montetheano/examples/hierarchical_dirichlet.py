@@ -31,13 +31,18 @@ marbles_bag_4 = numpy.asarray([[0],[0],[0],[0],[1]], dtype=theano.config.floatX)
 bag_prototype =  memoized(lambda bag: s_rng.dirichlet(numpy.asarray([1, 1, 1, 1, 1])*5))
 draw_marbles = lambda bag, nr: s_rng.multinomial(1, bag_prototype(bag), draw_shape=(nr,))
 
+# Every call of draw_marbles is a new draw: bind the observed marble of bag 4
+# and the new marble to predict from it separately
+observed_marble_4 = draw_marbles(4,1)
+new_marble_4 = draw_marbles(4,1)
+
 # Generate samples from the model
 givens = {draw_marbles(1,6): marbles_bag_1,
             draw_marbles(2,6): marbles_bag_2,
             draw_marbles(3,6): marbles_bag_3,
-            draw_marbles(4,1): marbles_bag_4}
+            observed_marble_4: marbles_bag_4}
             
-sampler = mh2_sample(s_rng, [draw_marbles(4,1)], givens)            
+sampler = mh2_sample(s_rng, [new_marble_4], givens)
 
 samples = sampler(200, 100, 100)
 data = samples[0]
@@ -57,13 +62,16 @@ prototype = phi*alpha
 bag_prototype =  memoized(lambda bag: s_rng.dirichlet(prototype))
 draw_marbles = lambda bag, nr: s_rng.multinomial(1, bag_prototype(bag), draw_shape=(nr,))
 
+observed_marble_4 = draw_marbles(4,1)
+new_marble_4 = draw_marbles(4,1)
+
 # Generate samples from the model
 givens = {draw_marbles(1,6): marbles_bag_1,
             draw_marbles(2,6): marbles_bag_2,
             draw_marbles(3,6): marbles_bag_3,
-            draw_marbles(4,1): marbles_bag_4}
+            observed_marble_4: marbles_bag_4}
             
-sampler = mh2_sample(s_rng, [draw_marbles(4,1)], givens)            
+sampler = mh2_sample(s_rng, [new_marble_4], givens)
 
 samples = sampler(200, 100, 100)
 data = samples[0]
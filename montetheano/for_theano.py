@@ -1,12 +1,194 @@
 import copy
+import hashlib
+import types
+from collections import OrderedDict
 import numpy
 import theano
 from theano import tensor
 from theano.gof import graph
 
+
+class LRUCache(object):
+    """
+    Mapping that keeps the `maxsize` most recently used entries.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# compiled or compiling machinery that an op may hold on to; not part of
+# what it computes
+_unstructural = (theano.gof.FunctionGraph, theano.gof.Linker,
+        theano.compile.Function, theano.compile.FunctionMaker, theano.Mode)
+
+def _signature(thing):
+    # a description of an op, or a property of one, that does not depend on
+    # the process (no ids or addresses)
+    if isinstance(thing, graph.Variable):
+        return _signature(thing.type)
+    if isinstance(thing, (tuple, list)):
+        if thing and all([isinstance(t, graph.Variable) for t in thing]):
+            # e.g. the inner graph of a scan
+            return _structural_key(thing, stable=True)
+        return tuple([_signature(t) for t in thing])
+    if isinstance(thing, dict) or hasattr(thing, 'items'):
+        return tuple(sorted([(repr(k), _signature(v)) for k, v in thing.items()]))
+    if isinstance(thing, numpy.ndarray):
+        return _constant_signature(thing)
+    if isinstance(thing, (type, types.FunctionType, types.BuiltinFunctionType)):
+        return '%s.%s' % (getattr(thing, '__module__', None), thing.__name__)
+    if isinstance(thing, _unstructural):
+        return type(thing).__name__
+    if hasattr(thing, '__dict__') and not isinstance(thing, theano.gof.Type):
+        cls = type(thing)
+        if hasattr(thing, '__props__'):
+            props = [(p, getattr(thing, p)) for p in thing.__props__]
+        else:
+            # private attributes are caches, hashes and the like
+            props = sorted([(k, v) for k, v in vars(thing).items()
+                if not k.startswith('_')])
+        return ('%s.%s' % (cls.__module__, cls.__name__),
+                tuple([(k, _signature(v)) for k, v in props]))
+    rval = repr(thing)
+    if ' at 0x' in rval:
+        # the default repr, with an address
+        return '%s.%s' % (type(thing).__module__, type(thing).__name__)
+    return rval
+
+def _constant_signature(data):
+    if isinstance(data, numpy.ndarray):
+        data = numpy.ascontiguousarray(data)
+        return (str(data.dtype), data.shape, hashlib.sha1(data.tostring()).hexdigest())
+    return repr(data)
+
+def _toposort(outputs):
+    # the apply nodes of the graph of `outputs`, inputs first, in an order
+    # that only depends on the structure of the graph
+    order = []
+    done = set()
+    stack = [(o, False) for o in reversed(outputs)]
+    while stack:
+        v, expanded = stack.pop()
+        node = v.owner
+        if node is None or node in done:
+            continue
+        if expanded:
+            done.add(node)
+            order.append(node)
+            continue
+        stack.append((v, True))
+        for i in reversed(node.inputs):
+            if i.owner is not None and i.owner not in done:
+                stack.append((i, False))
+    return order
+
+def _structural_key(outputs, givens=None, stable=False):
+    # A hashable description of the graph of `outputs` (and of the `givens`):
+    # every apply node as its op and the positions of its inputs, in
+    # topological order.  Constants are described by their value, other
+    # inputs (shared variables, ...) by their identity -- or, if `stable`,
+    # by their type and place in the graph only, and ops by their class and
+    # properties, so that the key can be compared across processes.
+    position = {}
+    key = []
+    def ref(v):
+        if v not in position:
+            if isinstance(v, graph.Constant):
+                if stable:
+                    key.append(('constant', _signature(v.type), _constant_signature(v.data)))
+                else:
+                    key.append(('constant', v.signature()))
+            elif stable:
+                key.append(('input', _signature(v.type)))
+            else:
+                key.append(('input', id(v), v.type))
+            position[v] = len(position)
+        return position[v]
+    givens = list((givens or {}).items())
+    roots = list(outputs) + [v for k, v in givens]
+    for node in _toposort(roots):
+        inputs = tuple([ref(i) for i in node.inputs])
+        if stable:
+            key.append((_signature(node.op), inputs))
+        else:
+            key.append((node.op, inputs))
+        for o in node.outputs:
+            position[o] = len(position)
+    key.append(tuple([ref(o) for o in outputs]))
+    key.append(tuple(sorted([(ref(k), ref(v)) for k, v in givens])))
+    return tuple(key)
+
+def structural_hash(outputs, givens=None):
+    """
+    Return a hex digest of the structure of the graph of `outputs` (a
+    variable or a list), with `givens`.
+
+    Graphs built the same way hash the same, also in different processes.
+    Constants enter the hash by value, shared variables by type and position
+    only, not by their current value.
+    """
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    key = _structural_key(outputs, givens, stable=True)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+# compiled functions of evaluate and infer_shape
+function_cache = LRUCache(128)
+
+def compiled_function(outputs, givens=None):
+    """
+    Return a function of no inputs computing `outputs` (a variable or a list),
+    compiled with the py linker and no optimizer.
+
+    Functions are kept in `function_cache`, keyed by the structure of the
+    graph, so evaluating the same graph -- or an identical one built again --
+    does not compile it again.
+    """
+    single = not isinstance(outputs, (list, tuple))
+    try:
+        key = (single, _structural_key([outputs] if single else outputs, givens))
+        hash(key)
+    except TypeError:
+        # some op or constant is not hashable
+        key = None
+    entry = function_cache.get(key) if key is not None else None
+    if entry is None:
+        f = theano.function([], outputs,
+                mode=theano.Mode(linker='py', optimizer=None), givens=givens)
+        if key is not None:
+            # the key refers to the inputs by id, so they must be kept alive
+            # as long as the entry; the givens are not otherwise referenced
+            function_cache[key] = (f, givens)
+        return f
+    return entry[0]
+
 def evaluate(var, givens=None):
-    f = theano.function([], var, mode=theano.Mode(linker='py', optimizer=None), givens=givens)
-    return f()
+    return compiled_function(var, givens)()
 
 class memoized(object):
     def __init__(self, func):
@@ -367,15 +549,85 @@ def clone_get_equiv(i, o, replacements=None):
 
 #XXX: rename -> clone_with_assignment
 def evaluate_with_assignments(f, assignment):
-    dfs_variables = ancestors([f], blockers=assignment.keys())
+    # membership tests go to the dict itself, not to a list of its keys.  The
+    # assigned values are kept as they are: cloning them along would cut the
+    # gradient with respect to them.
+    blockers = dict(assignment)
+    blockers.update([(v, v) for v in assignment.values()
+        if isinstance(v, theano.Variable)])
+    dfs_variables = ancestors([f], blockers=blockers)
     frontier = [r for r in dfs_variables
-            if r.owner is None or r in assignment.keys()]
+            if r.owner is None or r in blockers]
     cloned_inputs, cloned_outputs = clone_keep_replacements(frontier, [f],
             replacements=assignment)
     out, = cloned_outputs
     return out
 
 
+def vectorize(outputs, replacements):
+    """
+    Clone `outputs` with every key of `replacements` replaced by a batch of
+    values: its value in `replacements`, with the batch along a new leading
+    axis.
+
+    Return the batched outputs, each with the leading batch axis; it is
+    broadcastable (of length 1) for the outputs that do not depend on the
+    batch.  Only elementwise ops, dimshuffles and reductions are batched;
+    other ops that depend on the batch raise NotImplementedError.
+    """
+    outputs = list(outputs)
+    dfs_variables = ancestors(outputs, blockers=replacements)
+    frontier = [r for r in dfs_variables
+            if r.owner is None or r in replacements]
+    # every batched variable is padded to rank P+1, with the batch axis in
+    # front and broadcastable axes in between, so that they all line up
+    P = max([getattr(r, 'ndim', 0) for r in dfs_variables] + [0])
+
+    def lift(batch, ndim):
+        return batch.dimshuffle([0] + ['x'] * (P - ndim) + range(1, ndim + 1))
+
+    def lift_unbatched(r):
+        return r.dimshuffle(['x'] * (P + 1 - r.ndim) + range(r.ndim))
+
+    batched = {}
+    for r, batch in replacements.items():
+        batched[r] = lift(tensor.as_tensor_variable(batch), r.ndim)
+
+    for node in graph.io_toposort(frontier, outputs):
+        if not [i for i in node.inputs if i in batched]:
+            continue
+        op = node.op
+        if isinstance(op, tensor.Elemwise):
+            new_outputs = op.make_node(*[batched[i] if i in batched else lift_unbatched(i)
+                for i in node.inputs]).outputs
+        elif isinstance(op, tensor.DimShuffle):
+            ndim = node.inputs[0].ndim
+            order = [0] + ['x'] * (P - len(op.new_order)) + [o if o == 'x' else o + 1 + P - ndim
+                    for o in op.new_order]
+            new_outputs = [batched[node.inputs[0]].dimshuffle(order)]
+        elif isinstance(op, tensor.elemwise.CAReduce):
+            ndim = node.inputs[0].ndim
+            axis = op.axis
+            if axis is None:
+                axis = range(ndim)
+            reduce_op = copy.copy(op)
+            reduce_op.axis = tuple([a + 1 + P - ndim for a in axis])
+            out = reduce_op(batched[node.inputs[0]])
+            new_outputs = [out.dimshuffle([0] + ['x'] * len(axis) + range(1, out.ndim))]
+        else:
+            raise NotImplementedError('op does not broadcast over a batch', op)
+        for o, new in zip(node.outputs, new_outputs):
+            batched[o] = new
+
+    rval = []
+    for o in outputs:
+        if o in batched:
+            rval.append(batched[o].dimshuffle([0] + range(1 + P - o.ndim, P + 1)))
+        else:
+            rval.append(tensor.shape_padleft(o))
+    return rval
+
+
 #
 # SHAPE INFERENCE
 #
@@ -423,9 +675,7 @@ def infer_shape(v, assume_shared_size_fixed=True):
         if hasattr(o, 'data'):
             return int(o.data)
         elif hasattr(o, 'type'):
-            f = theano.function([], o,
-                    mode=theano.Mode(linker='py', optimizer=None))
-            return f()
+            return compiled_function(o)()
         else:
             return int(o)
     return tuple([as_int(r) for r in rval])
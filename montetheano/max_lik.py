@@ -1,18 +1,14 @@
 import numpy
 import theano
 from theano import tensor
-from for_theano import ancestors, infer_shape, evaluate_with_assignments, evaluate
-from rv import is_raw_rv, full_log_likelihood, lpdf
+from for_theano import infer_shape, evaluate_with_assignments, evaluate
+from rv import is_raw_rv, full_log_likelihood, lpdf, graph_index
 
 def likelihood_gradient(observations = {}, learning_rate = 0.1):
-    all_vars = ancestors(list(observations.keys()))
-    
     for o in observations:
-        assert o in all_vars
         if not is_raw_rv(o):
             raise TypeError(o)
-
-    RVs = [v for v in all_vars if is_raw_rv(v)]
+    RVs = graph_index.raw_rvs(list(observations.keys()))
     free_RVs = [v for v in RVs if v not in observations]
 
     # Instantiate actual values for the different random variables:
@@ -0,0 +1,102 @@
+"""
+Running independent MCMC chains in a pool of processes.
+
+The sampler is built and compiled once, in the parent.  The pool is forked
+after that, so every worker inherits the compiled functions instead of
+rebuilding the model.  Each worker reseeds its random states and writes its
+trace to a .npy file in shared memory, which the parent maps back in.
+"""
+import os
+import tempfile
+import multiprocessing
+import numpy
+from numpy.lib.format import open_memmap
+from rstreams import randomstate_types
+
+# the sampler the forked workers run; set by run_chains
+_sampler = None
+
+
+def random_states(sampler):
+    """
+    Return the shared RandomState variables a sampler draws from.
+
+    These are the random states reachable from `sampler.functions` (the
+    compiled theano functions it calls) plus any in `sampler.rstates`.
+    """
+    rval = list(getattr(sampler, 'rstates', []))
+    for f in getattr(sampler, 'functions', []):
+        for i in f.maker.inputs:
+            v = i.variable
+            if (isinstance(v.type, randomstate_types)
+                    and hasattr(v, 'get_value') and v not in rval):
+                rval.append(v)
+    return rval
+
+def reseed(sampler, seed):
+    """
+    Reseed numpy.random and every random state of `sampler` from `seed`.
+    """
+    seed_generator = numpy.random.RandomState(seed)
+    numpy.random.seed(seed_generator.randint(2**30))
+    for s in random_states(sampler):
+        s.set_value(numpy.random.RandomState(seed_generator.randint(2**30)),
+                borrow=True)
+
+def _shm_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def _run_one(args):
+    seed, nr_samples, burnin, lag = args
+    reseed(_sampler, seed)
+    trace = _sampler(nr_samples, burnin=burnin, lag=lag)
+    filenames = []
+    for t in trace:
+        fd, filename = tempfile.mkstemp(suffix='.npy', dir=_shm_dir())
+        os.close(fd)
+        t = numpy.asarray(t)
+        out = open_memmap(filename, mode='w+', dtype=t.dtype, shape=t.shape)
+        out[...] = t
+        del out
+        filenames.append(filename)
+    return filenames
+
+def run_chains(sampler, n_chains, nr_samples, burnin = 100, lag = 1,
+        seed = 0, processes = None):
+    """
+    Run `n_chains` independent chains of `sampler` in a multiprocessing pool.
+
+    `sampler(nr_samples, burnin, lag)` is a sampler such as the one returned by
+    mh2_sample, nuts_sample or sample.as_sampler.  Chain c is reseeded from the
+    c-th draw of numpy.random.RandomState(seed), so the result only depends on
+    `seed`.  All chains start from the state the sampler was built with.
+
+    Return one array per output with the chains along the first axis.
+    """
+    global _sampler
+    if n_chains < 1:
+        raise ValueError('n_chains must be at least 1', n_chains)
+    seeds = numpy.random.RandomState(seed).randint(2**30, size=n_chains)
+    _sampler = sampler
+    pool = multiprocessing.Pool(processes)
+    try:
+        filenames = pool.map(_run_one,
+                [(int(s), nr_samples, burnin, lag) for s in seeds])
+    finally:
+        pool.close()
+        pool.join()
+        _sampler = None
+
+    rval = []
+    try:
+        for k in range(len(filenames[0])):
+            chains = [numpy.load(f[k], mmap_mode='r') for f in filenames]
+            rval.append(numpy.asarray(chains))
+            del chains
+    finally:
+        for f in filenames:
+            for filename in f:
+                os.remove(filename)
+    return rval
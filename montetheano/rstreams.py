@@ -3,11 +3,14 @@ Registry and definition for new-and-improved RandomStreams
 """
 
 import copy
+from collections import OrderedDict
 import numpy
 import theano
 from theano import tensor
 from for_theano import elemwise_cond
 from for_theano import ancestors
+from for_theano import infer_shape
+from for_theano import _structural_key
 from utils import ClobberContext
 
 samplers = {}
@@ -15,6 +18,7 @@ pdfs = {}
 ml_handlers = {}
 params_handlers = {}
 local_proposals = {}
+local_proposal_lpdfs = {}
 randomstate_types = (tensor.raw_random.RandomStateType,)
 
 
@@ -27,10 +31,38 @@ def rv_dist_name(rv):
         except AttributeError:
             raise TypeError('rv not recognized as output of RandomFunction', rv)
 
+def _draw_key(dist_name, args, kwargs):
+    # the structure of a draw, or None if some argument can't be hashed
+    def arg_key(a):
+        if a is None:
+            return None
+        if isinstance(a, theano.Variable):
+            return _structural_key([a])
+        a = numpy.asarray(a)
+        if a.dtype == object:
+            raise TypeError(a)
+        return (str(a.dtype), a.shape, a.tostring())
+    try:
+        key = (dist_name, tuple([arg_key(a) for a in args]),
+                tuple(sorted([(k, arg_key(v)) for k, v in kwargs.items()])))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
 class RandomStreams(ClobberContext):
     clobber_symbols = ['pdf']
 
-    def __init__(self, seed, draw_shape=()):
+    def __init__(self, seed, draw_shape=(), hash_cons=False):
+        """
+        With `hash_cons`, drawing from the same distribution with structurally
+        identical arguments returns the RV of the first such draw instead of
+        a new one, like a memoized random function: e.g. a draw per value of
+        some index, made anew at every use of that index, then adds one RV
+        per distinct value to the graph instead of one per use.
+        """
+        self.hash_cons = hash_cons
+        self.consed = {}
         self.state_updates = []
         self.default_instance_seed = seed
         self.seed_generator = numpy.random.RandomState(seed)
@@ -76,9 +108,24 @@ class RandomStreams(ClobberContext):
             draw_shape = self.draw_shape
 
         kwargs['draw_shape'] = draw_shape
+        if self.hash_cons:
+            key = _draw_key(dist_name, args, kwargs)
+            if key is not None and key in self.consed:
+                return self.consed[key]
         out = handler(self, *args, **kwargs)
+        if self.hash_cons and key is not None:
+            self.consed[key] = out
         return out
 
+    def fresh_draws(self):
+        """
+        Return a context in which every draw is a new RV, even with
+        `hash_cons`.  The samplers make their own draws (acceptance
+        thresholds, momenta, proposals, conjugate updates) in it, so these stay
+        independent of each other and of the model.
+        """
+        return _FreshDraws(self)
+
     def seed(self, seed=None):
         """Re-initialize each random stream
 
@@ -149,6 +196,20 @@ class RandomStreams(ClobberContext):
         else:
             raise TypeError('rv not recognized as output of RandomFunction')
 
+    def local_proposal_lpdf(self, rv, proposal, sample, center, **kwargs):
+        """
+        Return the log density with which `proposal`, returned by
+        local_proposal(rv, center, **kwargs), takes value `sample`.
+
+        Proposals that are not themselves random variables of a registered
+        distribution register a `<dist>_proposal_lpdf` handler.
+        """
+        dist_name = rv_dist_name(rv)
+        if dist_name in local_proposal_lpdfs:
+            return local_proposal_lpdfs[dist_name](self, rv.owner, proposal, sample,
+                    center, kwargs)
+        return self.pdf(proposal, sample)
+
     #
     # N.B. OTHER METHODS (samplers) ARE INSTALLED HERE BY
     # - register_sampler
@@ -200,6 +261,13 @@ def register_params(dist_name, f):
     params_handlers[dist_name] = f
     return f
 
+def register_local_proposal_lpdf(dist_name, f):
+    if dist_name in local_proposal_lpdfs:
+        # TODO: allow for multiple handlers?
+        raise KeyError(dist_name, local_proposal_lpdfs[dist_name])
+    local_proposal_lpdfs[dist_name] = f
+    return f
+
 def register_local_proposal(dist_name, f):
     if dist_name in local_proposals:
         # TODO: allow for multiple handlers?
@@ -213,6 +281,10 @@ def rng_register(f):
         dist_name = f.__name__[:-len('_sampler')]
         return register_sampler(dist_name, f)
 
+    elif f.__name__.endswith('_proposal_lpdf'):
+        dist_name = f.__name__[:-len('_proposal_lpdf')]
+        return register_local_proposal_lpdf(dist_name, f)
+
     elif f.__name__.endswith('_lpdf'):
         dist_name = f.__name__[:-len('_lpdf')]
         return register_lpdf(dist_name, f)
@@ -232,3 +304,102 @@ def rng_register(f):
     else:
         raise ValueError("function name suffix not recognized", f.__name__)
 
+
+
+class _FreshDraws(object):
+    def __init__(self, rstream):
+        self.rstream = rstream
+
+    def __enter__(self):
+        self.hash_cons = self.rstream.hash_cons
+        self.rstream.hash_cons = False
+        return self.rstream
+
+    def __exit__(self, e_type, e_val, e_traceback):
+        self.rstream.hash_cons = self.hash_cons
+
+
+def adaptive_proposal(proposals, rv, **kwargs):
+    """
+    Return the AdaptiveProposal of `rv` in `proposals`, a dict that belongs
+    to one sampler, creating it with `kwargs` on first use.
+    """
+    if rv not in proposals:
+        proposals[rv] = AdaptiveProposal(rv, **kwargs)
+    return proposals[rv]
+
+
+class AdaptiveProposal(object):
+    """
+    Shared state of an adaptive random-walk proposal for `rv`.
+
+    The proposal is x + exp(log_scale) * L z with z standard normal.
+    `log_scale` follows a Robbins-Monro recursion toward `target_accept`,
+    with gain t**-0.6.  With `covariance`, the running mean and covariance
+    of the values of `rv` are accumulated in the graph as well, and refresh()
+    sets L to the Cholesky factor of that covariance (L is the identity
+    otherwise).  Everything lives in shared variables, so adaptation never
+    recompiles; freeze() stops it.
+    """
+    def __init__(self, rv, scale = 0.1, covariance = False, target_accept = 0.3):
+        floatX = theano.config.floatX
+        self.shape = infer_shape(rv)
+        self.size = int(numpy.prod(self.shape))
+        self.covariance = covariance
+        self.target_accept = target_accept
+        self.log_scale = theano.shared(numpy.asarray(numpy.log(scale), dtype=floatX))
+        self.t = theano.shared(numpy.asarray(1., dtype=floatX))
+        self.adapting = theano.shared(numpy.asarray(1., dtype=floatX))
+        if covariance:
+            self.count = theano.shared(numpy.asarray(0., dtype=floatX))
+            self.mean = theano.shared(numpy.zeros(self.size, dtype=floatX))
+            self.m2 = theano.shared(numpy.zeros((self.size, self.size), dtype=floatX))
+            self.chol = theano.shared(numpy.eye(self.size, dtype=floatX))
+
+    def proposal(self, rstream, sample):
+        scale = tensor.exp(self.log_scale)
+        if not self.covariance:
+            return rstream.normal(sample, scale, draw_shape=self.shape)
+        z = rstream.normal(0, 1, draw_shape=(self.size,))
+        return sample + scale * tensor.dot(self.chol, z).reshape(sample.shape)
+
+    def updates(self, accepts, values):
+        """
+        Return the updates that adapt the proposal to a batch of transitions:
+        `accepts` is a vector of acceptance indicators and `values` holds the
+        value of `rv` after each of them, along the first axis.
+        """
+        a = self.adapting
+        gain = a * self.t ** -0.6
+        rate = tensor.mean(tensor.cast(accepts, self.log_scale.dtype))
+        updates = OrderedDict([
+            (self.log_scale, tensor.cast(self.log_scale + gain * (rate - self.target_accept),
+                self.log_scale.dtype)),
+            (self.t, self.t + a)])
+        if self.covariance:
+            # merge the batch moments into the running ones
+            x = values.reshape((values.shape[0], self.size))
+            n = tensor.cast(x.shape[0], self.count.dtype) * a
+            count = self.count + n
+            mean = tensor.mean(x, axis=0)
+            d = x - mean
+            delta = mean - self.mean
+            w = n / tensor.maximum(count, 1.)
+            updates[self.count] = count
+            updates[self.mean] = self.mean + delta * w
+            updates[self.m2] = self.m2 + a * tensor.dot(d.T, d) \
+                    + tensor.outer(delta, delta) * self.count * w
+        return updates
+
+    def refresh(self, jitter = 1e-6):
+        """
+        Set the Cholesky factor from the covariance accumulated so far.
+        """
+        if not self.covariance or self.count.get_value() <= self.size + 1:
+            return
+        cov = self.m2.get_value() / (self.count.get_value() - 1)
+        cov += jitter * numpy.eye(self.size) * max(numpy.mean(numpy.diag(cov)), 1e-12)
+        self.chol.set_value(numpy.linalg.cholesky(cov).astype(self.chol.dtype))
+
+    def freeze(self):
+        self.adapting.set_value(numpy.asarray(0., dtype=self.adapting.dtype))
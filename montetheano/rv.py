@@ -1,9 +1,10 @@
 """
 Functions for operating on random variables.
 """
+import weakref
 import theano
 from theano import tensor
-from for_theano import ancestors, as_variable, clone_keep_replacements
+from for_theano import ancestors, as_variable, clone_keep_replacements, evaluate_with_assignments
 import rstreams
 
 
@@ -19,8 +20,8 @@ def is_rv(var, blockers=None):
 
     A random variable is a variable with a randomstate object in its ancestors.
     """    
-    #TODO: could optimize by stopping the recusion as soon as a randomstate is
-    #      found
+    if blockers is None:
+        return graph_index.is_rv(var)
     return any(is_randomstate(v) for v in ancestors([var], blockers=blockers))
 
 
@@ -31,6 +32,104 @@ def is_raw_rv(var):
     return var.owner and is_randomstate(var.owner.inputs[0])
 
 
+class GraphIndex(object):
+    """
+    Memoized queries about the random variables of theano graphs.
+
+    Theano graphs only grow: the inputs of a variable never change.  So every
+    answer about a variable is computed once, from the answers about its
+    inputs, and kept until the variable is garbage collected.  Extending a
+    graph only computes answers for the new variables; a query costs
+    O(answer) once its graph has been seen.
+    """
+    def __init__(self):
+        self.randomstate_memo = weakref.WeakKeyDictionary()
+        self.parents_memo = weakref.WeakKeyDictionary()
+
+    def _visit(self, var, memo, expand, f):
+        # fill `memo` for `var` and the ancestors it needs, inputs first
+        stack = [var]
+        while stack:
+            v = stack[-1]
+            if v in memo:
+                stack.pop()
+                continue
+            pending = [i for i in expand(v) if i not in memo]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            memo[v] = f(v)
+        return memo[var]
+
+    def is_rv(self, var):
+        """
+        Return True iff a randomstate is among the ancestors of `var`.
+        """
+        memo = self.randomstate_memo
+        def inputs(v):
+            return v.owner.inputs if v.owner else []
+        def f(v):
+            return is_randomstate(v) or any([memo[i] for i in inputs(v)])
+        return self._visit(var, memo, inputs, f)
+
+    def nearest_rvs(self, var):
+        """
+        Return the raw random variables that `var` depends on without going
+        through another raw random variable (`var` itself if it is one), as a
+        tuple in depth-first order.
+        """
+        # raw RVs answer for themselves and stay out of the memo: an entry
+        # (rv,) would keep its own weak key alive
+        if is_raw_rv(var):
+            return (var,)
+        memo = self.parents_memo
+        def inputs(v):
+            if v.owner is None:
+                return []
+            return [i for i in v.owner.inputs if not is_raw_rv(i)]
+        def f(v):
+            rval = []
+            for i in (v.owner.inputs if v.owner else []):
+                if is_raw_rv(i):
+                    parents = (i,)
+                else:
+                    parents = memo[i]
+                rval.extend([r for r in parents if r not in rval])
+            return tuple(rval)
+        return self._visit(var, memo, inputs, f)
+
+    def rv_parents(self, rv):
+        """
+        Return the nearest raw random variables of the parameters of `rv`.
+        """
+        rval = []
+        for i in rv.owner.inputs:
+            rval.extend([r for r in self.nearest_rvs(i) if r not in rval and r is not rv])
+        return rval
+
+    def raw_rvs(self, outputs):
+        """
+        Return all the raw random variables among the ancestors of `outputs`.
+        """
+        rval = []
+        seen = set()
+        stack = []
+        for o in reversed(list(outputs)):
+            stack.extend(reversed(self.nearest_rvs(o)))
+        while stack:
+            v = stack.pop()
+            if v in seen:
+                continue
+            seen.add(v)
+            rval.append(v)
+            stack.extend(reversed(self.rv_parents(v)))
+        return rval
+
+# the index used by the functions of this module
+graph_index = GraphIndex()
+
+
 def all_raw_rvs(outputs):
     """
     Return a list of all random variables required to compute `outputs`.
@@ -41,6 +140,109 @@ def all_raw_rvs(outputs):
     return rval
 
 
+def rv_parents(rv, RVs):
+    """
+    Return the random variables among `RVs` that the distribution of `rv`
+    depends on directly, i.e. without going through another one of `RVs`.
+    """
+    RVs = set(RVs)
+    rval = []
+    seen = set([rv])
+    # look through the raw RVs that are not among RVs
+    stack = list(reversed(graph_index.rv_parents(rv)))
+    while stack:
+        v = stack.pop()
+        if v in seen:
+            continue
+        seen.add(v)
+        if v in RVs:
+            rval.append(v)
+        else:
+            stack.extend(reversed(graph_index.rv_parents(v)))
+    return rval
+
+
+def rv_children(rv, RVs, parents=None):
+    """
+    Return the random variables among `RVs` that have `rv` as a parent.
+
+    parents - optional dict mapping each of `RVs` to its `rv_parents`, for
+        callers that ask about many variables of the same model.
+    """
+    if parents is None:
+        parents = dict([(v, rv_parents(v, RVs)) for v in RVs])
+    return [v for v in RVs if rv in parents[v]]
+
+
+def markov_blanket(rv, RVs, parents=None):
+    """
+    Return the Markov blanket of `rv` among `RVs`: its parents, its children
+    and the other parents of its children.
+    """
+    if parents is None:
+        parents = dict([(v, rv_parents(v, RVs)) for v in RVs])
+    children = rv_children(rv, RVs, parents)
+    blanket = list(parents[rv]) + children
+    for c in children:
+        blanket.extend(parents[c])
+    rval = []
+    for v in blanket:
+        if v is not rv and v not in rval:
+            rval.append(v)
+    return rval
+
+
+def color_classes(free_RVs, RVs, parents=None):
+    """
+    Partition `free_RVs` into classes such that no RV of a class is in the
+    Markov blanket (among `RVs`) of another RV of the same class.
+
+    The RVs of one class are conditionally independent given all the others,
+    so they can be updated together from the same state.  The coloring is
+    greedy, most constrained RVs first; the classes are returned largest
+    first, each in the order of `free_RVs`.
+    """
+    if parents is None:
+        parents = dict([(v, rv_parents(v, RVs)) for v in RVs])
+    children = dict([(v, []) for v in RVs])
+    for v in RVs:
+        for p in parents[v]:
+            children[p].append(v)
+    free = set(free_RVs)
+    neighbours = {}
+    for v in free_RVs:
+        blanket = set(parents[v]) | set(children[v])
+        for c in children[v]:
+            blanket.update(parents[c])
+        blanket.discard(v)
+        neighbours[v] = blanket & free
+
+    order = sorted(range(len(free_RVs)),
+            key=lambda i: (-len(neighbours[free_RVs[i]]), i))
+    color = {}
+    for i in order:
+        v = free_RVs[i]
+        used = set([color[u] for u in neighbours[v] if u in color])
+        c = 0
+        while c in used:
+            c += 1
+        color[v] = c
+    classes = [[] for c in range(len(set(color.values())))]
+    for v in free_RVs:
+        classes[color[v]].append(v)
+    classes.sort(key=len, reverse=True)
+    return classes
+
+
+def local_factors(rv, RVs, parents=None):
+    """
+    Return the random variables whose lpdf terms depend on the value of `rv`:
+    `rv` itself and its children.  These are the only terms of the full log
+    likelihood that change when `rv` alone is updated.
+    """
+    return [rv] + rv_children(rv, RVs, parents)
+
+
 def typed_items(dct):
     return dict([
         (rv, as_variable(sample, type=rv.type))
@@ -52,8 +254,12 @@ def condition(rvs, observations):
         raise NotImplementedError()
     observations = typed_items(observations)
     # if none of the rvs show up in the ancestors of any observations
-    # then this is easy conditioning
-    obs_ancestors = ancestors(observations.keys(), blockers=rvs)
+    # then this is easy conditioning.  The raw RVs among those ancestors
+    # come from the graph index; other rvs need a walk of the graph.
+    if all(is_raw_rv(rv) for rv in rvs):
+        obs_ancestors = set(graph_index.raw_rvs(observations.keys()))
+    else:
+        obs_ancestors = ancestors(observations.keys(), blockers=rvs)
     if any(rv in obs_ancestors for rv in rvs):
         # not-so-easy conditioning
         # we need to produce a sampler-driven model
@@ -120,11 +326,70 @@ def conditional_log_likelihood(assignment, givens):
                 for (new_rv, rv) in zip(new_rvs, rvs)],
             given={})
 
-def full_log_likelihood(assignment):
+class LogLikelihoodTerms(object):
+    """
+    The lpdf terms of `factors` (by default all of `RVs`), built once against
+    symbolic placeholders.
+
+    Every one of `RVs` is replaced by a placeholder of the same type in all
+    the terms, with a single clone of the model graph; `RVs` should hold all
+    the raw RVs the terms depend on, since the clone draws the others anew.
+    Calling the object with an assignment then only clones the terms that are
+    asked for, down to their placeholders, instead of building and cloning the
+    lpdfs again:
+
+        terms = LogLikelihoodTerms(RVs)
+        terms({rv0: val0, ...}, factors)   # like full_log_likelihood
+    """
+    def __init__(self, RVs, factors=None):
+        self.RVs = list(RVs)
+        if factors is None:
+            factors = self.RVs
+        factors = set(factors)
+        self.factors = [rv for rv in self.RVs if rv in factors]
+        self.placeholders = dict([(rv, rv.type()) for rv in self.RVs])
+        terms = [tensor.sum(lpdf(rv, self.placeholders[rv])) for rv in self.factors]
+        replacements = dict(self.placeholders)
+        frontier = [r for r in ancestors(terms, blockers=replacements)
+                if r.owner is None or r in replacements]
+        cloned_inputs, cloned_terms = clone_keep_replacements(frontier, terms,
+                replacements=replacements)
+        self.terms = dict(zip(self.factors, cloned_terms))
+        # the RVs whose placeholders each term depends on
+        owners = dict([(p, rv) for rv, p in self.placeholders.items()])
+        self.depends = dict([(rv, [owners[v] for v in ancestors([t]) if v in owners])
+            for rv, t in self.terms.items()])
+
+    def __call__(self, assignment, factors=None):
+        """
+        Return the sum of the terms of `factors` (by default all of them),
+        with the values of `assignment` (a dict RV -> value) in place of the
+        placeholders.  Unassigned RVs stand for themselves.
+        """
+        if factors is None:
+            factors = self.factors
+        # summed in the order of self.RVs, whatever the order of `factors`
+        factors = set(factors)
+        factors = [rv for rv in self.factors if rv in factors]
+        lik = tensor.add(*[self.terms[rv] for rv in factors])
+        replacements = {}
+        for f in factors:
+            for rv in self.depends[f]:
+                if rv not in replacements:
+                    replacements[rv] = as_variable(assignment.get(rv, rv), type=rv.type)
+        return evaluate_with_assignments(lik, dict([(self.placeholders[rv], value)
+            for rv, value in replacements.items()]))
+
+
+def full_log_likelihood(assignment, factors=None, terms=None):
     """
     Return log(P(rv0=sample))
 
     assignment: rv0=val0, rv1=val1, ...
+    factors: optional list of random variables; when given, only their lpdf
+        terms are summed (see `local_factors`).
+    terms: optional LogLikelihoodTerms of the model, to take the lpdf terms
+        from instead of building them.
 
     Each of val0, val1, ... v0, v1, ... is supposed to represent an identical
     number of draws from a distribution.  This function returns the real-valued
@@ -138,9 +403,12 @@ def full_log_likelihood(assignment):
         if not is_rv(rv):
             raise ValueError('non-random var in assignment key', rv)
 
+    if terms is not None:
+        return terms(assignment, factors)
+
     # All random variables that are not assigned should stay as the same object so it can later be replaced
     # If this is not done this way, they get cloned
-    RVs = [v for v in ancestors(assignment.keys()) if is_raw_rv(v)]
+    RVs = graph_index.raw_rvs(assignment.keys())
     for rv in RVs:
         if rv not in assignment:
             assignment[rv] = rv
@@ -148,16 +416,11 @@ def full_log_likelihood(assignment):
     # Cast assignment elements to the right kind of thing
     assignment = typed_items(assignment)
 
-    pdfs = [lpdf(rv, sample) for rv, sample in assignment.items()]
+    if factors is None:
+        factors = assignment.keys()
+    pdfs = [lpdf(rv, assignment[rv]) for rv in factors]
     lik = tensor.add(*[tensor.sum(p) for p in pdfs])
-    
-    dfs_variables = ancestors([lik], blockers=assignment.keys())
-    frontier = [r for r in dfs_variables
-            if r.owner is None or r in assignment.keys()]
-    cloned_inputs, cloned_outputs = clone_keep_replacements(frontier, [lik],
-            replacements=assignment)
-    cloned_lik, = cloned_outputs
-    return cloned_lik
+    return evaluate_with_assignments(lik, assignment)
 
 
 def energy(assignment, given):
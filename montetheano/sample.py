@@ -2,11 +2,18 @@
 Algorithms for drawing samples by MCMC
 
 """
+import time
+import functools
 import numpy
 import theano
 from theano import tensor
-from for_theano import ancestors, infer_shape, evaluate_with_assignments, evaluate
-from rv import is_raw_rv, full_log_likelihood, lpdf
+from theano.compile import deep_copy_op
+from for_theano import infer_shape, evaluate_with_assignments, vectorize
+from rv import is_raw_rv, full_log_likelihood, lpdf, typed_items, rv_parents, rv_children, local_factors, \
+        color_classes, LogLikelihoodTerms, graph_index
+from diagnostics import ChainMonitor
+from conjugacy import conjugate_update, collapse_dirichlet_multinomial
+from compiled import CompiledFunctions
 
 
 # Major TODOs:
@@ -15,7 +22,6 @@ from rv import is_raw_rv, full_log_likelihood, lpdf
 # - We need proposal distributions for all RVs from which to draw samples
 # - An additional loop around mh_sample is required
 # - An efficient parallel MC sampler is possible, which might be less decorrelated (or more book-keeping is required)
-# - The HMC sampler needs an outside loop and an additional inner loop for the leap-frog steps
 
 
 
@@ -46,15 +52,205 @@ def rejection_sample(outputs, condition = None):
         sample = [s[-1] for s in samples]
     return sample, updates
 
-def mh_sample(s_rng, outputs, observations = {}):
-    all_vars = ancestors(list(outputs) + list(observations.keys()))
-    
+def _iter_chain(step, nr_samples, burnin, lag, chunk_size, after_burnin = None):
+    """
+    Drive a chain through `burnin` transitions, then keep the outputs after
+    every `lag` further transitions, yielding them `chunk_size` draws at a time.
+
+    `step(n)` advances the chain by n transitions and returns the current value
+    of every output.  Every chunk is a list with one freshly allocated array
+    per output, with the draws along the first axis; the last chunk may be
+    shorter.  With `nr_samples` None the chain runs until the caller stops
+    iterating.  `after_burnin`, if given, is called once burn-in is done.
+    """
+    if burnin:
+        step(burnin)
+    if after_burnin is not None:
+        after_burnin()
+    done = 0
+    while nr_samples is None or done < nr_samples:
+        n = chunk_size
+        if nr_samples is not None:
+            n = min(n, nr_samples - done)
+        chunk = []
+        for i in range(n):
+            values = step(lag)
+            if not chunk:
+                chunk = [numpy.empty((n,) + numpy.shape(v), dtype=numpy.asarray(v).dtype)
+                        for v in values]
+            for c, v in zip(chunk, values):
+                c[i] = v
+        done += n
+        yield chunk
+
+def _squeeze_draws(d):
+    # like d.squeeze(), but keeps the draw axis of a chunk of length 1
+    return d.reshape(d.shape[:1] + tuple([s for s in d.shape[1:] if s != 1]))
+
+def _monitored(chunks, monitor):
+    for chunk in chunks:
+        monitor.update(chunk)
+        yield chunk
+
+def _reached(ess, target_ess):
+    # whether every output reached its target ESS: `target_ess` is one target
+    # for all the outputs, or a list with one target (or None) per output
+    if not isinstance(target_ess, (list, tuple)):
+        target_ess = [target_ess] * len(ess)
+    if len(target_ess) != len(ess):
+        raise ValueError('one target_ess per output is required', target_ess)
+    return all([t is None or numpy.all(e >= t) for e, t in zip(ess, target_ess)])
+
+def _until(chunks, monitor, target_ess, max_seconds):
+    # stop drawing once every output has reached its `target_ess` effective
+    # draws, or after `max_seconds` of wall-clock time, both checked between
+    # chunks
+    start = time.time()
+    for chunk in chunks:
+        yield chunk
+        if max_seconds is not None and time.time() - start >= max_seconds:
+            return
+        if target_ess is not None and _reached(monitor.ess(), target_ess):
+            return
+
+def _make_sampler(step, default_lag, squeeze = True, after_burnin = None):
+    """
+    Return the sampler(nr_samples, burnin, lag, ...) closure shared by the
+    samplers below around `step` (see _iter_chain).
+
+    With `chunk_size` the sampler returns a generator of chunks.  With `store`
+    (a traces.TraceStore) the chunks are appended to the store as they are
+    produced and the sampler returns store.read().  With `checkpoint` (a
+    checkpoint.Checkpointer, used together with `store`) the chain state is
+    saved after every chunk.  With `monitor` (e.g. a
+    diagnostics.ChainMonitor) every chunk is passed to monitor.update.
+
+    With `target_ess` and/or `max_seconds` the chain stops early, at the end
+    of the first chunk after which the ESS of every output element reaches
+    its target or `max_seconds` have passed.  `target_ess` is either one
+    target for all the outputs or a list with one per output, None for an
+    output that is not waited for.  Both are only checked between chunks, so
+    a run can overrun `max_seconds` by up to one chunk; pass a smaller
+    `chunk_size` for a tighter limit.  `nr_samples` may then be None for no
+    upper bound on the number of draws.
+    """
+    def sampler(nr_samples, burnin = 100, lag = default_lag, chunk_size = None,
+            store = None, checkpoint = None, monitor = None,
+            target_ess = None, max_seconds = None):
+        if checkpoint is not None and store is None:
+            raise ValueError('checkpoint requires a store')
+        stopping = target_ess is not None or max_seconds is not None
+        if nr_samples is None and not stopping:
+            raise ValueError('nr_samples is None without a stopping rule')
+        if target_ess is not None and monitor is None:
+            monitor = ChainMonitor()
+        size = chunk_size
+        if size is None and store is not None:
+            size = store.chunk_size
+        if size is None and (monitor is not None or stopping):
+            size = 100
+        chunks = _iter_chain(step, nr_samples, burnin, lag, size or nr_samples,
+                after_burnin)
+        if squeeze:
+            chunks = ([_squeeze_draws(d) for d in chunk] for chunk in chunks)
+        if monitor is not None:
+            chunks = _monitored(chunks, monitor)
+        if stopping:
+            chunks = _until(chunks, monitor, target_ess, max_seconds)
+
+        if store is not None:
+            for chunk in chunks:
+                store.append(chunk)
+                if checkpoint is not None:
+                    checkpoint.save(n_draws=len(store))
+            if checkpoint is not None:
+                checkpoint.wait()
+            return store.read()
+        if chunk_size:
+            return chunks
+        chunks = list(chunks)
+        if len(chunks) == 1:
+            data = chunks[0]
+        elif chunks:
+            data = [numpy.concatenate(d) for d in zip(*chunks)]
+        else:
+            data = []
+        if squeeze:
+            return [d.squeeze() for d in data]
+        return data
+    return sampler
+
+def _fresh_draws(sampler):
+    # the draws a sampler makes itself are never hash-consed (see
+    # RandomStreams.fresh_draws)
+    @functools.wraps(sampler)
+    def wrapper(s_rng, *args, **kwargs):
+        with s_rng.fresh_draws():
+            return sampler(s_rng, *args, **kwargs)
+    return wrapper
+
+def as_sampler(states, updates, givens = {}, cache_dir = None):
+    """
+    Compile the `states` and `updates` returned by mh_sample or hybridmc_sample
+    into a sampler(nr_samples, burnin, lag) like the one of mh2_sample, whose
+    draws are squeezed the same way.
+
+    With `cache_dir` the compiled function is cached on disk (see compiled.py).
+    """
+    functions = CompiledFunctions(cache_dir)
+    f = functions.function([], states, updates=updates, givens=givens)
+    read = functions.function([], states, givens=givens)
+    functions.compile()
+
+    def step(n):
+        if n == 0:
+            return read()
+        for i in range(n):
+            values = f()
+        return values
+
+    sampler = _make_sampler(step, 1)
+
+    sampler.functions = functions.functions
+    return sampler
+
+def _model_rvs(s_rng, outputs, observations, observations_first = False):
+    """
+    Return the raw RVs of the model of `outputs` and `observations`, and
+    whether their order is the same in every process.
+
+    The observations are taken in the order `s_rng` drew them rather than in
+    dict order, which in Python 2 follows object ids.  If some of them were
+    drawn from another stream there is no such order, and the compiled
+    functions of the sampler should not be cached on disk.
+    """
     for o in observations:
-        assert o in all_vars
         if not is_raw_rv(o):
             raise TypeError(o)
+    position = dict([(r, i) for i, (r, new_r) in enumerate(s_rng.state_updates)])
+    observed = list(observations.keys())
+    stable = all([o.owner.inputs[0] in position for o in observed])
+    if stable:
+        observed.sort(key=lambda o: position[o.owner.inputs[0]])
+    if observations_first:
+        return graph_index.raw_rvs(observed + list(outputs)), stable
+    return graph_index.raw_rvs(list(outputs) + observed), stable
+
+@_fresh_draws
+def mh_sample(s_rng, outputs, observations = {}, n_chains = None):
+    """
+    Return the states of `outputs`, the log likelihood and an updates dictionary
+    that move a Metropolis-Hastings chain by one accepted step.
 
-    RVs = [v for v in all_vars if is_raw_rv(v)]
+    With `n_chains` set, every free RV state gets a leading chain axis and the
+    returned updates move all `n_chains` chains in one compiled call: the
+    proposals, the lpdf terms (see for_theano.vectorize) and the acceptance
+    test are computed for all chains at once, and every chain retries until
+    it has accepted a proposal.  The log likelihood then holds one value per
+    chain.  This needs local proposals that draw around a batch of points,
+    and lpdfs built from elementwise ops and reductions.
+    """
+    RVs = _model_rvs(s_rng, outputs, observations)[0]
     free_RVs = [v for v in RVs if v not in observations]
 
     # Draw sample from the proposal
@@ -62,7 +258,17 @@ def mh_sample(s_rng, outputs, observations = {}):
     for v in free_RVs:
         f = theano.function([], v,
                 mode=theano.Mode(linker='py', optimizer=None))
-        free_RVs_state.append(theano.shared(f()))
+        if n_chains is None:
+            free_RVs_state.append(theano.shared(f()))
+        else:
+            # every chain starts from its own draw
+            free_RVs_state.append(theano.shared(
+                numpy.asarray([f() for c in range(n_chains)])))
+
+    if n_chains is not None:
+        updates, log_likelihood = _mh_chains(s_rng, observations,
+                RVs, free_RVs, free_RVs_state, n_chains)
+        return [free_RVs_state[free_RVs.index(out)] for out in outputs], log_likelihood, updates
 
     log_likelihood = theano.shared(numpy.array(float('-inf')))
 
@@ -74,7 +280,7 @@ def mh_sample(s_rng, outputs, observations = {}):
 
         full_observations = dict(observations)
         full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, proposals)]))
-        new_log_likelihood = full_log_likelihood(full_observations)
+        new_log_likelihood = full_log_likelihood(full_observations, RVs)
 
         logratio = new_log_likelihood - ll \
             + tensor.add(*[tensor.sum(lpdf(p, r)) for p, r in zip(proposals_rev, frvs)]) \
@@ -92,84 +298,595 @@ def mh_sample(s_rng, outputs, observations = {}):
     
     return [free_RVs_state[free_RVs.index(out)] for out in outputs], log_likelihood, updates
 
-def hybridmc_sample(s_rng, outputs, observations = {}):
-    # TODO: should there be a size variable here?
-    # TODO: implement lag and burn-in
-    # TODO: implement size
+def _per_chain(x):
+    # sum `x` over every axis but the leading chain axis
+    if x.ndim < 2:
+        return x
+    return tensor.sum(x, axis=range(1, x.ndim))
+
+def _mh_chains(s_rng, observations, RVs, free_RVs, free_RVs_state, n_chains):
     """
-    Return a dictionary mapping random variables to their sample values.
+    Build the updates of mh_sample(n_chains=...) over `free_RVs_state`, whose
+    leading axis runs over the chains.  Return the updates and the shared log
+    likelihood of every chain.
     """
+    log_likelihood = theano.shared(numpy.repeat(float('-inf'), n_chains))
 
-    all_vars = ancestors(list(outputs) + list(observations.keys()))
-    
-    for o in observations:
-        assert o in all_vars
-        if not is_raw_rv(o):
-            raise TypeError(o)
+    # one acceptance threshold per chain
+    U = s_rng.uniform(low=0.0, high=1.0, draw_shape=(n_chains,))
 
-    RVs = [v for v in all_vars if is_raw_rv(v)]
+    # the lpdf terms of one chain, batched over the chains below
+    observed = typed_items(observations)
+    terms = [lpdf(rv, observed.get(rv, rv)) for rv in RVs]
+
+    def chain_log_likelihood(values):
+        batched = vectorize(terms, dict(zip(free_RVs, values)))
+        return tensor.add(*[_per_chain(t) for t in batched])
+
+    def where(accept, new, old):
+        return tensor.switch(accept.dimshuffle(*([0] + ['x'] * (new.ndim - 1))), new, old)
+
+    def mcmc(ll, done, *frvs):
+        proposals = [s_rng.local_proposal(v, rvs) for v, rvs in zip(free_RVs, frvs)]
+        proposals_rev = [s_rng.local_proposal(v, rvs) for v, rvs in zip(free_RVs, proposals)]
+        for v, p, rvs in zip(free_RVs, proposals, frvs):
+            if p.ndim != rvs.ndim:
+                raise NotImplementedError('local proposal does not draw around a batch', v)
+
+        new_log_likelihood = tensor.cast(chain_log_likelihood(proposals), ll.dtype)
+
+        logratio = new_log_likelihood - ll \
+            + tensor.add(*[_per_chain(s_rng.local_proposal_lpdf(v, p, r, c))
+                for v, p, r, c in zip(free_RVs, proposals_rev, frvs, proposals)]) \
+            - tensor.add(*[_per_chain(s_rng.local_proposal_lpdf(v, p, p, r))
+                for v, p, r in zip(free_RVs, proposals, frvs)])
+
+        # chains that have accepted already keep their state
+        accept = tensor.and_(tensor.gt(logratio, tensor.log(U)), tensor.eq(done, 0))
+        done = tensor.or_(done, accept)
+
+        return [tensor.switch(accept, new_log_likelihood, ll), done] + \
+               [where(accept, p, f) for p, f in zip(proposals, frvs)], \
+               {}, theano.scan_module.until(tensor.all(done))
+
+    # all false, with the dtype of a comparison
+    done = tensor.lt(U, 0.)
+    samples, updates = theano.scan(mcmc,
+            outputs_info = [log_likelihood, done] + free_RVs_state, n_steps = 100)
+    updates[log_likelihood] = samples[0][-1]
+    updates.update([(f, s[-1]) for f, s in zip(free_RVs_state, samples[2:])])
+    return updates, log_likelihood
+
+def _hybridmc_graph(s_rng, observations, RVs, free_RVs, free_RVs_state, n_leapfrog, epsilon,
+        inv_mass, max_tries = None):
+    """
+    Build one HMC transition over `free_RVs_state`, the states of `free_RVs`
+    among the RVs `RVs` of the model.  A transition retries
+    proposals until one is accepted.  With `max_tries` set it gives up after
+    that many proposals and leaves the state unchanged.
+
+    `epsilon` is a shared scalar and `inv_mass` a list of shared variables
+    (the diagonal of the inverse mass matrix, one per free RV), so both can be
+    changed between calls without recompiling.
+
+    Return the energy at the new state, the new states, the mean acceptance
+    probability of the trials and the scan updates.
+    """
+    n = len(free_RVs)
 
-    free_RVs = [v for v in RVs if v not in observations]
-    
-    free_RVs_state = [theano.shared(numpy.ones(shape=infer_shape(v)), broadcastable=tuple(numpy.asarray(infer_shape(v))==1)) for v in free_RVs]
-    free_RVs_prop = [s_rng.normal(0, 1, draw_shape=infer_shape(v)) for v in free_RVs]
-    
-    log_likelihood = theano.shared(numpy.array(float('-inf')))
-    
     U = s_rng.uniform(low=0, high=1.0)
-    
-    epsilon = numpy.sqrt(2*0.03)
-    def mcmc(ll, *frvs):
+
+    def energy(frvs):
         full_observations = dict(observations)
         full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, frvs)]))
-        
-        loglik = -full_log_likelihood(full_observations)
+        E = -full_log_likelihood(full_observations, RVs)
+        return E, tensor.grad(E, frvs)
 
-        proposals = free_RVs_prop
-        H = tensor.add(*[tensor.sum(tensor.sqr(p)) for p in proposals])/2. + loglik
+    def kinetic(p):
+        return tensor.add(*[tensor.sum(m*tensor.sqr(pp)) for pp, m in zip(p, inv_mass)])/2.
 
-# -- this should be an inner loop
-        g = []
-        g.append(tensor.grad(loglik, frvs))
-        
-        proposals = [(p - epsilon*gg[0]/2.) for p, gg in zip(proposals, g)]
+    def leapfrog(*qpg):
+        q, p, g = qpg[:n], qpg[n:2*n], qpg[2*n:]
+        p = [pp - epsilon*gg/2. for pp, gg in zip(p, g)]
+        q = [qq + epsilon*m*pp for qq, pp, m in zip(q, p, inv_mass)]
+        E, g = energy(q)
+        p = [pp - epsilon*gg/2. for pp, gg in zip(p, g)]
+        return q + p + g + [E]
 
-        rvsp = [(rvs + epsilon*rvp) for rvs,rvp in zip(frvs, proposals)]
-        
-        full_observations = dict(observations)
-        full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, rvsp)]))
-        new_loglik = -full_log_likelihood(full_observations)
-        
-        gnew = []
-        gnew.append(tensor.grad(new_loglik, rvsp))
-        proposals = [(p - epsilon*gn[0]/2.) for p, gn in zip(proposals, gnew)]
-# --
-        
-        Hnew = tensor.add(*[tensor.sum(tensor.sqr(p)) for p in proposals])/2. + new_loglik
+    def mcmc(E, *qga):
+        q, g = list(qga[:n]), list(qga[n:2*n])
+        accept_sum, tries = qga[2*n:]
+        p = [s_rng.normal(0, 1, draw_shape=infer_shape(v))/tensor.sqrt(m)
+                for v, m in zip(free_RVs, inv_mass)]
+        H = kinetic(p) + E
+
+        steps, _ = theano.scan(leapfrog, outputs_info = q + p + g + [None], n_steps = n_leapfrog)
+        steps = [s[-1] for s in steps]
+        qnew, pnew, gnew, Enew = steps[:n], steps[n:2*n], steps[2*n:3*n], steps[3*n]
+
+        Hnew = kinetic(pnew) + Enew
 
         dH = Hnew - H
         accept = tensor.or_(dH < 0., U < tensor.exp(-dH))
 
-        return [tensor.switch(accept, -new_loglik, ll)] + \
-            [tensor.switch(accept, p, f) for p, f in zip(rvsp, frvs)], \
+        return [tensor.switch(accept, Enew, E)] + \
+            [tensor.switch(accept, new, old) for new, old in zip(qnew, q)] + \
+            [tensor.switch(accept, new, old) for new, old in zip(gnew, g)] + \
+            [accept_sum + tensor.minimum(1., tensor.exp(-dH)), tries + 1], \
             {}, theano.scan_module.until(accept)
 
-    samples, updates = theano.scan(mcmc, outputs_info = [log_likelihood] + free_RVs_state, n_steps = 10000000)
+    # the energy and its gradient at the current state are computed once per
+    # call, every further gradient comes out of a leapfrog step
+    E0, g0 = energy(free_RVs_state)
+    # the acceptance statistic is summed in the scan rather than averaged
+    # over an output of length max_tries
+    zero = tensor.constant(0., dtype=E0.dtype)
+    if max_tries is None:
+        max_tries = 10000000
+    samples, updates = theano.scan(mcmc,
+            outputs_info = [E0] + free_RVs_state + list(g0) + [zero, zero],
+            n_steps = max_tries)
+
+    # scan allocates buffers of length max_tries for the states; copying the
+    # last entry keeps the new states from holding on to them
+    return samples[0][-1], [deep_copy_op(s[-1]) for s in samples[1:n+1]], \
+        samples[-2][-1] / samples[-1][-1], updates
+
+
+def _hybridmc_setup(s_rng, outputs, observations, epsilon, inv_mass):
+    RVs, stable = _model_rvs(s_rng, outputs, observations)
+
+    free_RVs = [v for v in RVs if v not in observations]
     
-    updates[log_likelihood] = samples[0][-1]
-    updates.update(dict([(f, s[-1]) for f, s in zip(free_RVs_state, samples[1:])]))
+    free_RVs_state = [theano.shared(numpy.ones(shape=infer_shape(v)), broadcastable=tuple(numpy.asarray(infer_shape(v))==1)) for v in free_RVs]
+
+    if epsilon is None:
+        epsilon = numpy.sqrt(2*0.03)
+    if not isinstance(epsilon, theano.compile.SharedVariable):
+        epsilon = theano.shared(numpy.asarray(epsilon, dtype=theano.config.floatX))
+
+    inv_mass = dict(inv_mass or {})
+    for v, s in zip(free_RVs, free_RVs_state):
+        m = inv_mass.get(v, 1.)
+        if not isinstance(m, theano.compile.SharedVariable):
+            m = theano.shared(m * numpy.ones_like(s.get_value()),
+                    broadcastable=s.broadcastable)
+        inv_mass[v] = m
+
+    return RVs, stable, free_RVs, free_RVs_state, epsilon, inv_mass
+
+
+@_fresh_draws
+def hybridmc_sample(s_rng, outputs, observations = {}, n_leapfrog = 1,
+        epsilon = None, inv_mass = None, max_tries = None):
+    # TODO: should there be a size variable here?
+    # TODO: implement size
+    """
+    Return a dictionary mapping random variables to their sample values.
+
+    Each proposal integrates `n_leapfrog` leapfrog steps.  The gradient of the
+    energy is carried from step to step (and from one accepted state to the
+    next) so every leapfrog step costs a single `tensor.grad`.
+
+    `epsilon` (step size) and `inv_mass` (dict mapping free RVs to the diagonal
+    of their inverse mass matrix) may be given as shared variables; see
+    hybridmc_adapt for tuning them.  Each transition retries proposals until
+    one is accepted; with `max_tries` it makes at most that many and leaves
+    the state unchanged if none is accepted.  Use as_sampler to draw from the
+    result.
+    """
+    RVs, stable, free_RVs, free_RVs_state, epsilon, inv_mass = _hybridmc_setup(
+            s_rng, outputs, observations, epsilon, inv_mass)
+
+    log_likelihood = theano.shared(numpy.array(float('-inf')))
+
+    E, new_state, accept_prob, updates = _hybridmc_graph(s_rng, observations,
+            RVs, free_RVs, free_RVs_state, n_leapfrog, epsilon,
+            [inv_mass[v] for v in free_RVs], max_tries)
+
+    updates[log_likelihood] = -E
+    updates.update(dict(zip(free_RVs_state, new_state)))
     
     return [free_RVs_state[free_RVs.index(out)] for out in outputs], log_likelihood, updates
 
-def mh2_sample(s_rng, outputs, observations = {}, givens = {}):    
-    all_vars = ancestors(list(observations.keys()) + list(outputs))
-        
-    for o in observations:
-        assert o in all_vars
-        if not is_raw_rv(o):
-            raise TypeError(o)
+
+class DualAveraging(object):
+    """
+    Step size adaptation by dual averaging (Hoffman & Gelman, 2014, algorithm 5).
+
+    Call update() with the acceptance statistic of every warmup transition;
+    the shared `epsilon` is set to the new step size each time, and to the
+    averaged step size by finalize().
+    """
+    def __init__(self, epsilon, target_accept = 0.65, gamma = 0.05, t0 = 10, kappa = 0.75):
+        self.epsilon = epsilon
+        self.target_accept = target_accept
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.restart()
+
+    def restart(self):
+        self.mu = numpy.log(10 * self.epsilon.get_value())
+        self.t = 0
+        self.H_bar = 0.
+        self.log_epsilon_bar = 0.
+
+    def update(self, accept_prob):
+        self.t += 1
+        w = 1. / (self.t + self.t0)
+        self.H_bar = (1 - w) * self.H_bar + w * (self.target_accept - accept_prob)
+        log_epsilon = self.mu - numpy.sqrt(self.t) / self.gamma * self.H_bar
+        eta = self.t ** -self.kappa
+        self.log_epsilon_bar = eta * log_epsilon + (1 - eta) * self.log_epsilon_bar
+        self.epsilon.set_value(numpy.asarray(numpy.exp(log_epsilon),
+            dtype=self.epsilon.dtype))
+
+    def finalize(self):
+        self.epsilon.set_value(numpy.asarray(numpy.exp(self.log_epsilon_bar),
+            dtype=self.epsilon.dtype))
+
+
+@_fresh_draws
+def hybridmc_adapt(s_rng, outputs, observations = {}, givens = {}, n_leapfrog = 1,
+        n_warmup = 1000, target_accept = 0.65, epsilon = None, inv_mass = None,
+        max_tries = 100, cache_dir = None):
+    """
+    Build and compile a hybridmc_sample transition, then run `n_warmup`
+    transitions adapting the step size by dual averaging and the diagonal mass
+    matrix from the variance of the warmup draws.
+
+    `epsilon` and `inv_mass` (a dict mapping free RVs to the diagonal of their
+    inverse mass matrix; arrays, scalars or shared variables) are the values
+    the adaptation starts from, as for hybridmc_sample.  Unlike there,
+    `max_tries` defaults to a cap: early in the warmup the step size can be
+    far too large for any proposal to be accepted.
+
+    Both live in shared variables, so adaptation never recompiles.  Return
+    the warmed-up sampler(nr_samples, burnin, lag) drawing `outputs` like the
+    one of as_sampler, with the shared `epsilon` and the dict of shared
+    inverse masses, which can also be passed on to hybridmc_sample.  The log
+    likelihood of the current state is in the shared
+    sampler.log_likelihood.  With `cache_dir` the compiled functions are
+    cached on disk (see compiled.py), unless some observations were not drawn
+    from `s_rng` (see _model_rvs).
+    """
+    RVs, stable, free_RVs, free_RVs_state, epsilon, inv_mass = _hybridmc_setup(
+            s_rng, outputs, observations, epsilon, inv_mass)
+
+    log_likelihood = theano.shared(numpy.array(float('-inf')))
+
+    E, new_state, accept_prob, updates = _hybridmc_graph(s_rng, observations,
+            RVs, free_RVs, free_RVs_state, n_leapfrog, epsilon,
+            [inv_mass[v] for v in free_RVs], max_tries)
+    updates[log_likelihood] = -E
+    updates.update(dict(zip(free_RVs_state, new_state)))
+
+    out_state = [new_state[free_RVs.index(out)] for out in outputs]
+    if not stable:
+        cache_dir = None
+    functions = CompiledFunctions(cache_dir)
+    f = functions.function([], [accept_prob] + new_state + out_state,
+            updates=updates, givens=givens, allow_input_downcast=True)
+    read = functions.function([], [free_RVs_state[free_RVs.index(out)] for out in outputs],
+            givens=givens)
+    functions.compile()
+
+    # Mass matrix windows as in Stan: a fast initial phase that only adapts
+    # epsilon, slow windows of doubling length that estimate the variance of
+    # the draws, and a final fast phase.
+    init_buffer = int(0.15 * n_warmup)
+    slow_end = n_warmup - int(0.1 * n_warmup)
+    window = 25
+    window_end = min(init_buffer + window, slow_end)
+    n = 0
+    mean = [numpy.zeros_like(s.get_value()) for s in free_RVs_state]
+    m2 = [numpy.zeros_like(s.get_value()) for s in free_RVs_state]
+
+    adapt = DualAveraging(epsilon, target_accept)
+    for i in range(n_warmup):
+        r = f()
+        adapt.update(float(r[0]))
+
+        if init_buffer <= i < slow_end:
+            n += 1
+            for k, x in enumerate(r[1:len(free_RVs)+1]):
+                delta = x - mean[k]
+                mean[k] += delta / n
+                m2[k] += delta * (x - mean[k])
+
+            if i + 1 == window_end:
+                for v, s in zip(free_RVs, m2):
+                    var = s / max(n - 1, 1)
+                    # regularize toward unit mass like Stan does
+                    var = (n / (n + 5.)) * var + 1e-3 * (5. / (n + 5.))
+                    inv_mass[v].set_value(numpy.asarray(var,
+                        dtype=inv_mass[v].dtype))
+                adapt.restart()
+                n = 0
+                mean = [numpy.zeros_like(m) for m in mean]
+                m2 = [numpy.zeros_like(m) for m in m2]
+                window *= 2
+                window_end += window
+                if window_end + 2 * window > slow_end:
+                    window_end = slow_end
+    adapt.finalize()
+
+    k = len(free_RVs) + 1
+    def step(n):
+        if n == 0:
+            return read()
+        for i in range(n):
+            values = f()[k:]
+        return values
+
+    sampler = _make_sampler(step, 1)
+
+    sampler.log_likelihood = log_likelihood
+    sampler.functions = functions.functions
+    return sampler, epsilon, inv_mass
+
+@_fresh_draws
+def nuts_sample(s_rng, outputs, observations = {}, givens = {},
+        epsilon = numpy.sqrt(2*0.03), max_tree_depth = 10, delta_max = 1000.,
+        cache_dir = None):
+    """
+    Return a sampler(nr_samples, burnin, lag) drawing `outputs` with the
+    No-U-Turn Sampler (Hoffman & Gelman, 2014, algorithm 3).
+
+    The log likelihood and its gradient are the same `full_log_likelihood` and
+    `tensor.grad` expressions that hybridmc_sample uses, compiled once into a
+    single function.  Trajectories are doubled until they make a U-turn, so
+    there is no number of leapfrog steps to tune.
+
+    The depth of every tree and whether its trajectory diverged are recorded
+    in `sampler.stats`, for the transitions of the latest call.  With `cache_dir` the compiled functions are cached on
+    disk (see compiled.py), unless some observations were not drawn from
+    `s_rng` (see _model_rvs).
+    """
+    RVs, stable = _model_rvs(s_rng, outputs, observations, observations_first=True)
+    if not stable:
+        cache_dir = None
+    free_RVs = [v for v in RVs if v not in observations]
+
+    free_RVs_state = []
+    for v in free_RVs:
+        f = theano.function([], v,
+                mode=theano.Mode(linker='py', optimizer=None))
+        free_RVs_state.append(theano.shared(f()))
+    shapes = [s.get_value(borrow=True).shape for s in free_RVs_state]
+    sizes = [int(numpy.prod(shp)) for shp in shapes]
+
+    # momenta and the uniform draws of the tree building come from a
+    # RandomState that lives in a shared variable like every other stream
+    rng = s_rng.new_shared_rstate()
+
+    q = [v.type() for v in free_RVs]
+    full_observations = dict(observations)
+    full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, q)]))
+    loglik = full_log_likelihood(full_observations, RVs)
+    functions = CompiledFunctions(cache_dir)
+    logp_grad = functions.function(q, [loglik] + tensor.grad(loglik, q),
+            givens=givens, allow_input_downcast=True)
+
+    outputs_fn = functions.function(q,
+            [evaluate_with_assignments(o, typed_items(full_observations)) for o in outputs],
+            givens=givens, allow_input_downcast=True, on_unused_input='ignore')
+    functions.compile()
+
+    def unpack(x):
+        rval = []
+        for shp, size in zip(shapes, sizes):
+            rval.append(x[:size].reshape(shp))
+            x = x[size:]
+        return rval
+
+    def logp(x):
+        r = logp_grad(*unpack(x))
+        return r[0], numpy.concatenate([numpy.ravel(g) for g in r[1:]])
+
+    def leapfrog(x, r, g, eps):
+        r = r + eps*g/2.
+        x = x + eps*r
+        lp, g = logp(x)
+        r = r + eps*g/2.
+        return x, r, g, lp
+
+    def no_uturn(xm, xp, rm, rp):
+        dx = xp - xm
+        return numpy.dot(dx, rm) >= 0 and numpy.dot(dx, rp) >= 0
+
+    def build_tree(x, r, g, logu, v, j, joint0, state):
+        if j == 0:
+            x1, r1, g1, lp1 = leapfrog(x, r, g, v*epsilon)
+            joint = lp1 - numpy.dot(r1, r1)/2.
+            n1 = int(logu <= joint)
+            s1 = logu < delta_max + joint
+            if not s1:
+                state['diverging'] = True
+            return x1, r1, g1, x1, r1, g1, x1, g1, lp1, n1, s1, \
+                    min(1., numpy.exp(joint - joint0)), 1
+        xm, rm, gm, xp, rp, gp, x1, g1, lp1, n1, s1, a1, na1 = \
+                build_tree(x, r, g, logu, v, j - 1, joint0, state)
+        if s1:
+            if v == -1:
+                xm, rm, gm, _, _, _, x2, g2, lp2, n2, s2, a2, na2 = \
+                        build_tree(xm, rm, gm, logu, v, j - 1, joint0, state)
+            else:
+                _, _, _, xp, rp, gp, x2, g2, lp2, n2, s2, a2, na2 = \
+                        build_tree(xp, rp, gp, logu, v, j - 1, joint0, state)
+            if state['rng'].uniform() < float(n2) / max(n1 + n2, 1):
+                x1, g1, lp1 = x2, g2, lp2
+            a1 += a2
+            na1 += na2
+            s1 = s2 and no_uturn(xm, xp, rm, rp)
+            n1 += n2
+        return xm, rm, gm, xp, rp, gp, x1, g1, lp1, n1, s1, a1, na1
+
+    stats = {'tree_depth': [], 'diverging': [], 'accept': []}
+
+    def transition(x, lp, g):
+        state = {'rng': rng.get_value(borrow=True), 'diverging': False}
+        r0 = state['rng'].normal(size=x.shape)
+        joint0 = lp - numpy.dot(r0, r0)/2.
+        logu = joint0 - state['rng'].exponential()
+
+        xm = xp = x
+        rm = rp = r0
+        gm = gp = g
+        j, n, s = 0, 1, True
+        a, na = 0., 1
+        while s and j < max_tree_depth:
+            v = 2*int(state['rng'].uniform() < .5) - 1
+            if v == -1:
+                xm, rm, gm, _, _, _, x1, g1, lp1, n1, s1, a, na = \
+                        build_tree(xm, rm, gm, logu, v, j, joint0, state)
+            else:
+                _, _, _, xp, rp, gp, x1, g1, lp1, n1, s1, a, na = \
+                        build_tree(xp, rp, gp, logu, v, j, joint0, state)
+            if s1 and state['rng'].uniform() < float(n1) / n:
+                x, lp, g = x1, lp1, g1
+            n += n1
+            s = s1 and no_uturn(xm, xp, rm, rp)
+            j += 1
+
+        stats['tree_depth'].append(j)
+        stats['diverging'].append(state['diverging'])
+        stats['accept'].append(a / na)
+        return x, lp, g
+
+    def step(n):
+        x = numpy.concatenate([numpy.ravel(s.get_value(borrow=True)) for s in free_RVs_state])
+        lp, g = logp(x)
+        for i in range(n):
+            x, lp, g = transition(x, lp, g)
+        for s, value in zip(free_RVs_state, unpack(x)):
+            s.set_value(value)
+        return outputs_fn(*unpack(x))
+
+    draw = _make_sampler(step, 1)
+
+    @functools.wraps(draw)
+    def sampler(*args, **kwargs):
+        for v in stats.values():
+            del v[:]
+        return draw(*args, **kwargs)
+
+    sampler.stats = stats
+    sampler.functions = functions.functions
+    sampler.state = free_RVs_state
+    sampler.rstates = [rng]
+    return sampler
+
+def _mh_site(s_rng, index, free_RVs, values, observations, factors=None,
+        proposal_kw={}, terms=None):
+    """
+    Build a single-site Metropolis-Hastings update of free_RVs[index].
+
+    `values` holds the current value of every free RV.  When `factors` is
+    given only those lpdf terms enter the acceptance ratio; the other terms
+    cancel.  `proposal_kw` is passed on to s_rng.local_proposal, and `terms`
+    (a rv.LogLikelihoodTerms) to full_log_likelihood.  Return the
+    value of free_RVs[index] after the update and whether the proposal was
+    accepted.
+    """
+    U = s_rng.uniform(low=0.0, high=1.0)
+
+    full_observations = dict(observations)
+    full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, values)]))
+    log_likelihood = full_log_likelihood(full_observations, factors, terms)
     
-    RVs = [v for v in all_vars if is_raw_rv(v)]
+    site_rv = free_RVs[index]
+    proposal = s_rng.local_proposal(site_rv, values[index], **proposal_kw)
+    proposal_rev = s_rng.local_proposal(site_rv, proposal, **proposal_kw)
+
+    full_observations = dict(observations)
+    full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, values)]))
+    full_observations.update(dict([(free_RVs[index], proposal)]))
+    new_log_likelihood = full_log_likelihood(full_observations, factors, terms)
+
+    bw = tensor.sum(s_rng.local_proposal_lpdf(site_rv, proposal_rev, values[index],
+        proposal, **proposal_kw))
+    fw = tensor.sum(s_rng.local_proposal_lpdf(site_rv, proposal, proposal,
+        values[index], **proposal_kw))
+
+    lr = new_log_likelihood-log_likelihood+bw-fw
+
+    accept = tensor.gt(lr, tensor.log(U))
+
+    return tensor.switch(accept, proposal, values[index]), accept
+
+def _gibbs_site(s_rng, index, free_RVs, values, observations, update):
+    """
+    Build an exact Gibbs update of free_RVs[index] from the conjugate
+    `update` (see conjugacy.conjugate_update).  Return the new value and,
+    like _mh_site, an acceptance flag, which is always true.
+    """
+    full_observations = dict(observations)
+    full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, values)]))
+    def given(expr):
+        return evaluate_with_assignments(expr, typed_items(full_observations))
+    return update(s_rng, given), tensor.constant(1, dtype='int8')
+
+@_fresh_draws
+def mh2_sample(s_rng, outputs, observations = {}, givens = {}, sweep = False, n_sweeps = 1,
+        adaptive = False, covariance = False, conjugate = False, collapse = False,
+        colored = False, cache_dir = None):
+    """
+    Return a sampler(nr_samples, burnin, lag) drawing `outputs` by single-site
+    Metropolis-Hastings.
+
+    By default one function is compiled per free RV and every transition
+    updates one RV chosen at random.  With `sweep` a single function is
+    compiled instead; every transition is `n_sweeps` systematic-scan sweeps
+    that update each free RV in turn.  Burn-in and the `lag` transitions
+    between kept draws then each run inside a single call of that function.
+
+    Every update only evaluates the lpdf terms of the updated RV and its
+    children (see rv.local_factors).  The terms of the model are built once
+    (see rv.LogLikelihoodTerms) and every update clones only its own.
+
+    With `adaptive` the random-walk proposals that support it (see
+    rstreams.AdaptiveProposal) tune their scale toward a target acceptance
+    rate during burn-in, and with `covariance` also learn the covariance of
+    each RV from its draws.  Adaptation runs in blocks of 10 transitions and
+    stops after burn-in.  The proposals belong to the sampler, by RV, in
+    sampler.adaptive_proposals.
+
+    With `conjugate` every free RV that forms a registered conjugate family
+    with its children (see conjugacy.py) is redrawn from its full conditional
+    instead; the others keep their Metropolis-Hastings updates.  The list of
+    these RVs is sampler.conjugate.
+
+    With `colored` the free RVs are partitioned into classes that share no
+    Markov blanket (see rv.color_classes), and the RVs of a class are updated
+    together from the same state: one compiled function per class, chosen at
+    random, or in turn within a sweep.  Models with many RVs that are
+    conditionally independent given a few others then need a handful of
+    functions and calls instead of one per RV.  The classes are
+    sampler.classes.
+
+    With `cache_dir` the compiled functions are cached on disk, keyed by the
+    structure of the model, so that building the same sampler again -- in
+    another process -- loads them instead of compiling (see compiled.py).
+    Observations drawn from another stream than `s_rng` turn the cache off
+    (see _model_rvs).
+
+    With `collapse` the dirichlet RVs that only serve as the p of multinomials
+    are first integrated out (see conjugacy.collapse_dirichlet_multinomial);
+    sampler.collapsed maps them to the multinomials they were collapsed into.
+
+    sampler(nr_samples, burnin, lag, chunk_size=k) returns a generator instead,
+    yielding the draws k at a time as they are produced; with store=TraceStore
+    they are written to disk (see _make_sampler).
+    """
+    collapsed = {}
+    if collapse:
+        outputs, observations, collapsed = collapse_dirichlet_multinomial(
+                s_rng, outputs, observations)
+    RVs, stable = _model_rvs(s_rng, outputs, observations, observations_first=True)
+    if not stable:
+        cache_dir = None
     free_RVs = [v for v in RVs if v not in observations]
     
     free_RVs_state = []
@@ -177,54 +894,143 @@ def mh2_sample(s_rng, outputs, observations = {}, givens = {}):
         f = theano.function([], v,
                 mode=theano.Mode(linker='py', optimizer=None))
         free_RVs_state.append(theano.shared(f()))
+
+    parents = dict([(v, rv_parents(v, RVs)) for v in RVs])
+    factors = [local_factors(v, RVs, parents) for v in free_RVs]
+    updates_conj = [None] * len(free_RVs)
+    if conjugate:
+        updates_conj = [conjugate_update(v, rv_children(v, RVs, parents), RVs)
+                for v in free_RVs]
+    # the lpdf terms the Metropolis-Hastings updates need, with placeholders
+    # for all the RVs: observed ones and those of Gibbs updates included
+    terms = LogLikelihoodTerms(RVs, [v for v in RVs if [i for i in range(len(free_RVs))
+        if updates_conj[i] is None and v in factors[i]]])
     
-    U = s_rng.uniform(low=0.0, high=1.0)
-    
-    rr = []
-    for index in range(len(free_RVs)):
-        # TODO: why does the compiler crash when we try to expose the likelihood ?
-        full_observations = dict(observations)
-        full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, free_RVs_state)]))
-        log_likelihood = full_log_likelihood(full_observations)
-        
-        proposal = s_rng.local_proposal(free_RVs[index], free_RVs_state[index])
-        proposal_rev = s_rng.local_proposal(free_RVs[index], proposal)
+    if colored:
+        classes = color_classes(free_RVs, RVs, parents)
+        blocks = [[free_RVs.index(v) for v in c] for c in classes]
+    else:
+        blocks = [[index] for index in range(len(free_RVs))]
+
+    functions = CompiledFunctions(cache_dir)
+
+    # the AdaptiveProposals of this sampler, by RV
+    adaptive_proposals = {}
+    proposal_kw = {}
+    if adaptive:
+        proposal_kw = dict(adaptive=adaptive_proposals, covariance=covariance)
+
+    def site(index, values):
+        if updates_conj[index] is not None:
+            return _gibbs_site(s_rng, index, free_RVs, values, observations,
+                    updates_conj[index])
+        return _mh_site(s_rng, index, free_RVs, values, observations,
+                factors[index], proposal_kw, terms)
+
+    def adaptation(index, accepts, values):
+        # updates adapting the proposal of free_RVs[index], if it is adaptive
+        if not adaptive or free_RVs[index] not in adaptive_proposals:
+            return {}
+        return adaptive_proposals[free_RVs[index]].updates(accepts, values)
 
+    def outputs_given(values):
+        # outputs as expressions of the given values of the free RVs
         full_observations = dict(observations)
-        full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, free_RVs_state)]))
-        full_observations.update(dict([(free_RVs[index], proposal)]))
-        new_log_likelihood = full_log_likelihood(full_observations)
+        full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, values)]))
+        return [evaluate_with_assignments(o, typed_items(full_observations)) for o in outputs]
 
-        bw = tensor.sum(lpdf(proposal_rev, free_RVs_state[index]))
-        fw = tensor.sum(lpdf(proposal, proposal))
+    if sweep:
+        def one_sweep(*values):
+            values = list(values)
+            accepts = [None] * len(free_RVs)
+            for block in blocks:
+                current = list(values)
+                for index in block:
+                    values[index], accepts[index] = site(index, current)
+            return values + accepts
 
-        lr = new_log_likelihood-log_likelihood+bw-fw
+        n_steps = tensor.iscalar('n_steps')
+        sweeps, updates = theano.scan(one_sweep,
+                outputs_info = free_RVs_state + [None]*len(free_RVs), n_steps = n_steps)
+        final = [v[-1] for v in sweeps[:len(free_RVs)]]
+        updates.update(dict(zip(free_RVs_state, final)))
+        for index in range(len(free_RVs)):
+            updates.update(adaptation(index, sweeps[len(free_RVs) + index], sweeps[index]))
+        sweep_fn = functions.function([n_steps], outputs_given(final),
+                updates=updates, givens=givens)
+        # scan cannot run 0 steps: with lag=0 the current state is read
+        read = functions.function([], outputs_given(free_RVs_state), givens=givens)
 
-        accept = tensor.gt(lr, tensor.log(U))
+        def transitions(n):
+            # all n*n_sweeps sweeps run inside the compiled scan, and the
+            # outputs are computed from its final state
+            if n * n_sweeps == 0:
+                return read()
+            return sweep_fn(n * n_sweeps)
+    else:
+        rr = []
+        for block in blocks:
+            # TODO: why does the compiler crash when we try to expose the likelihood ?
+            updates = []
+            accepts = []
+            for index in block:
+                new_value, accept = site(index, free_RVs_state)
+                updates.append((free_RVs_state[index], new_value))
+                updates.extend(adaptation(index, tensor.shape_padleft(accept),
+                    tensor.shape_padleft(new_value)).items())
+                accepts.append(accept)
+            rr.append(functions.function([], accepts, updates=updates, givens=givens))
+
+        # derived outputs are compiled once against the state shared variables
+        read = functions.function([], outputs_given(free_RVs_state), givens=givens)
+
+        def transitions(n):
+            for i in range(n):
+                accept = False
+                while not accept:
+                    index = numpy.random.randint(len(rr))
+
+                    accept = rr[index]()
+            return read()
+
+    functions.compile()
+
+    proposals = [adaptive_proposals[v] for v in free_RVs
+            if v in adaptive_proposals]
+    adapting = [bool(proposals)]
 
-        updates = {free_RVs_state[index] : tensor.switch(accept, proposal, free_RVs_state[index])}
-        rr.append(theano.function([], [accept], updates=updates, givens=givens))
+    def step(n):
+        if not adapting[0] or n == 0:
+            return transitions(n)
+        while n > 0:
+            values = transitions(min(n, 10))
+            n -= 10
+            for p in proposals:
+                p.refresh()
+        return values
+
+    def stop_adapting():
+        adapting[0] = False
+        for p in proposals:
+            p.freeze()
     
-    # TODO: this exacte amount of samples given back is still wrong
-    def sampler(nr_samples, burnin = 100, lag = 100):
-        data = [[] for o in outputs]
-        for i in range(nr_samples*lag+burnin):        
-            accept = False
-            while not accept:
-                index = numpy.random.randint(len(free_RVs))
-
-                accept = rr[index]()            
-                if accept and i > burnin and (i-burnin) % lag == 0:
-                    for d, o in zip(data, outputs):
-                        # TODO: this can be optimized
-                        if is_raw_rv(o):
-                            d.append(free_RVs_state[free_RVs.index(o)].get_value())
-                        else:
-                            full_observations = dict(observations)
-                            full_observations.update(dict([(rv, s) for rv, s in zip(free_RVs, free_RVs_state)]))
-                            d.append(evaluate(evaluate_with_assignments(o, full_observations), givens=givens))
-        data = [numpy.asarray(d).squeeze() for d in data]
-        
-        return data
+    sampler = _make_sampler(step, 100, after_burnin=stop_adapting)
     
-    return sampler
\ No newline at end of file
+    sampler.state = free_RVs_state
+    sampler.conjugate = [v for v, u in zip(free_RVs, updates_conj) if u is not None]
+    sampler.collapsed = collapsed
+    sampler.classes = [[free_RVs[index] for index in block] for block in blocks]
+    sampler.functions = functions.functions
+    sampler.adaptive_proposals = adaptive_proposals
+    return sampler
+
+def gibbs_sample(s_rng, outputs, observations = {}, givens = {}, n_sweeps = 1, **kwargs):
+    """
+    Return a sampler(nr_samples, burnin, lag) drawing `outputs` by
+    systematic-scan Gibbs sampling: exact conditional draws for the free RVs
+    with a conjugate family (see conjugacy.py), Metropolis-Hastings updates
+    for the others.  This is mh2_sample with `sweep` and `conjugate`; other
+    keyword arguments go to mh2_sample.
+    """
+    return mh2_sample(s_rng, outputs, observations, givens, sweep=True,
+            n_sweeps=n_sweeps, conjugate=True, **kwargs)
@@ -0,0 +1,198 @@
+"""
+Streaming posterior summaries.
+
+The accumulators here take chunks of draws as they are produced and keep
+O(parameters) memory however long the chain runs: running means and
+variances, a running covariance, and a mergeable quantile sketch.  All of
+them can be merged, so the summaries of parallel chains combine into the
+summary of the pooled draws.
+"""
+import numpy
+from diagnostics import RunningMoments
+
+
+class RunningCovariance(object):
+    """
+    Running mean and covariance of the flattened draws of one output.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.c = None
+
+    def merge(self, count, mean, c):
+        if count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.c = count, numpy.array(mean), numpy.array(c)
+            return self
+        n = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(count) / n)
+        self.c = self.c + c + numpy.outer(delta, delta) * (float(self.count) * count / n)
+        self.count = n
+        return self
+
+    def update(self, draws):
+        draws = numpy.asarray(draws, dtype='float64')
+        if len(draws) == 0:
+            return self
+        draws = draws.reshape((len(draws), -1))
+        mean = draws.mean(axis=0)
+        x = draws - mean
+        return self.merge(len(draws), mean, numpy.dot(x.T, x))
+
+    def __iadd__(self, other):
+        return self.merge(other.count, other.mean, other.c)
+
+    def covariance(self, ddof = 1):
+        return self.c / (self.count - ddof)
+
+
+class QuantileSketch(object):
+    """
+    Elementwise KLL quantile sketch.
+
+    Every element of the draws has its own sketch, but the compactors of all
+    elements are stored together, as arrays (n_items, n_elements).  Level h
+    holds items of weight 2**h; when the sketch outgrows its capacity the
+    lowest over-full level is sorted and every other item, from a random
+    offset, is promoted to the next level.  The rank error is about 1/k.
+    """
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.rng = numpy.random.RandomState(seed)
+        self.levels = []
+        self.shape = None
+        self.count = 0
+
+    def _capacity(self, h):
+        return max(2, int(numpy.ceil(self.k * (2. / 3) ** (len(self.levels) - h - 1))))
+
+    def _compact(self, h):
+        level = numpy.sort(self.levels[h], axis=0)
+        # an odd item out stays behind
+        odd = len(level) % 2
+        promoted = level[odd:][self.rng.randint(2)::2]
+        self.levels[h] = level[:odd]
+        if h + 1 == len(self.levels):
+            self.levels.append(promoted)
+        else:
+            self.levels[h + 1] = numpy.concatenate([self.levels[h + 1], promoted])
+
+    def _compress(self):
+        # like KLL, only compact while the sketch as a whole is over capacity,
+        # and then the lowest level that is over its own capacity
+        while sum([len(l) for l in self.levels]) > \
+                sum([self._capacity(h) for h in range(len(self.levels))]):
+            for h in range(len(self.levels)):
+                if len(self.levels[h]) > self._capacity(h):
+                    self._compact(h)
+                    break
+
+    def update(self, draws):
+        draws = numpy.asarray(draws, dtype='float64')
+        if len(draws) == 0:
+            return self
+        self.shape = draws.shape[1:]
+        draws = draws.reshape((len(draws), -1))
+        if not self.levels:
+            self.levels = [draws]
+        else:
+            self.levels[0] = numpy.concatenate([self.levels[0], draws])
+        self.count += len(draws)
+        self._compress()
+        return self
+
+    def __iadd__(self, other):
+        if other.count == 0:
+            return self
+        self.shape = other.shape
+        for h, level in enumerate(other.levels):
+            if h < len(self.levels):
+                self.levels[h] = numpy.concatenate([self.levels[h], level])
+            else:
+                self.levels.append(level)
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Return the estimated `q` quantile (a float in [0, 1]) of every element.
+        """
+        items = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([numpy.repeat(2. ** h, len(level))
+                for h, level in enumerate(self.levels)])
+        order = numpy.argsort(items, axis=0)
+        cdf = numpy.cumsum(weights[order], axis=0)
+        i = numpy.argmax(cdf >= q * cdf[-1], axis=0)
+        rval = items[order[i, numpy.arange(items.shape[1])], numpy.arange(items.shape[1])]
+        return rval.reshape(self.shape)
+
+
+class PosteriorSummary(object):
+    """
+    Means, variances, quantiles and (with `covariance`) covariances of every
+    output of a sampler.
+
+    It follows the monitor protocol of the samplers in sample.py --
+    update(chunk) takes a list with one array of draws per output -- see
+    summarize for running a sampler without keeping its trace.  Summaries of
+    parallel chains are combined with +=.
+    """
+    def __init__(self, covariance = False, k = 200, seed = None):
+        self.covariance = covariance
+        self.k = k
+        self.seed = seed
+        self.moments = None
+
+    def update(self, chunk, chain = 0):
+        if self.moments is None:
+            self.moments = [RunningMoments() for d in chunk]
+            self.sketches = [QuantileSketch(self.k, self.seed) for d in chunk]
+            if self.covariance:
+                self.covariances = [RunningCovariance() for d in chunk]
+        for k, draws in enumerate(chunk):
+            self.moments[k].update(draws)
+            self.sketches[k].update(draws)
+            if self.covariance:
+                self.covariances[k].update(draws)
+
+    def __iadd__(self, other):
+        if self.moments is None:
+            self.moments = [RunningMoments() for m in other.moments]
+            self.sketches = [QuantileSketch(self.k, self.seed) for m in other.moments]
+            if self.covariance:
+                self.covariances = [RunningCovariance() for m in other.moments]
+        for k in range(len(self.moments)):
+            self.moments[k] += other.moments[k]
+            self.sketches[k] += other.sketches[k]
+            if self.covariance:
+                self.covariances[k] += other.covariances[k]
+        return self
+
+    def mean(self):
+        return [m.mean for m in self.moments]
+
+    def variance(self):
+        return [m.variance() for m in self.moments]
+
+    def cov(self):
+        return [c.covariance() for c in self.covariances]
+
+    def quantile(self, q):
+        return [s.quantile(q) for s in self.sketches]
+
+
+def summarize(sampler, nr_samples, summary = None, chunk_size = 100, **kwargs):
+    """
+    Run `sampler` for `nr_samples` draws, feeding them to `summary` (a new
+    PosteriorSummary by default) and discarding them.  Other keyword
+    arguments go to the sampler.  Return the summary.
+    """
+    if summary is None:
+        summary = PosteriorSummary()
+    for chunk in sampler(nr_samples, chunk_size=chunk_size, **kwargs):
+        summary.update(chunk)
+    return summary
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import numpy
+import theano
+from theano import tensor
+from checkpoint import Checkpointer, chain_state
+
+
+def test_save_restore():
+    R = tensor.shared_randomstreams.RandomStreams(234)
+    s = theano.shared(numpy.zeros(3))
+    f = theano.function([], s, updates={s: s + R.normal(size=(3,))})
+    def sampler():
+        pass
+    sampler.functions = [f]
+    assert len(chain_state(sampler)) == 2
+
+    d = tempfile.mkdtemp()
+    try:
+        cp = Checkpointer(os.path.join(d, 'cp'), sampler)
+        f()
+        cp.save(n_draws=1)
+        cp.wait()
+        expected = [f() for i in range(3)], numpy.random.rand()
+        f(); numpy.random.rand()
+        assert cp.restore() == dict(n_draws=1)
+        assert numpy.all(numpy.asarray([f() for i in range(3)]) == expected[0])
+        assert numpy.random.rand() == expected[1]
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,131 @@
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import numpy
+import theano
+from theano import tensor
+from compiled import CompiledFunctions
+
+
+def build(cache_dir, restore_rng = False):
+    R = tensor.shared_randomstreams.RandomStreams(234)
+    s = theano.shared(numpy.zeros(3))
+    functions = CompiledFunctions(cache_dir, restore_rng)
+    step = functions.function([], s, updates=[(s, s + R.normal(size=(3,)))])
+    read = functions.function([], s * 2)
+    functions.compile()
+    return functions, s, step, read
+
+def test_cache():
+    d = tempfile.mkdtemp()
+    try:
+        functions, s, step, read = build(d)
+        assert not functions.loaded
+        expected = [step() for i in range(3)] + [s.get_value()]
+        assert numpy.allclose(read(), 2 * expected[-1])
+
+        # the same model, built again, loads the compiled functions and binds
+        # them to its own shared variables
+        functions, s, step, read = build(d)
+        assert functions.loaded
+        assert numpy.allclose(read(), 0)
+        s.set_value(numpy.zeros(3))
+        assert numpy.all(numpy.asarray([step() for i in range(3)]) == expected[:3])
+        assert numpy.all(s.get_value() == expected[-1])
+        assert len(functions.functions) == 2
+
+        # the loaded functions use our shared variables, not copies of them
+        for f in functions.functions:
+            inputs = [i.variable for i in f.maker.inputs]
+            assert s in inputs
+            assert len(set(map(id, inputs))) == len(inputs)
+    finally:
+        shutil.rmtree(d)
+
+def test_rng_states():
+    d = tempfile.mkdtemp()
+    try:
+        functions, s, step, read = build(d)
+        step()
+        functions.save()
+        state = s.get_value()
+        step()
+        expected = s.get_value()
+
+        # the RandomState is restored only on request
+        functions, s, step, read = build(d)
+        assert functions.loaded and len(functions.rng_states) == 1
+        s.set_value(state)
+        step()
+        assert not numpy.all(s.get_value() == expected)
+
+        functions, s, step, read = build(d, restore_rng=True)
+        s.set_value(state)
+        step()
+        assert numpy.all(s.get_value() == expected)
+    finally:
+        shutil.rmtree(d)
+
+def test_no_cache():
+    functions, s, step, read = build(None)
+    assert not functions.loaded
+    step()
+    assert numpy.allclose(read(), 2 * s.get_value())
+
+def build_samplers(cache_dir):
+    # samplers of a model with several observations, built in fresh processes
+    # by test_cache_across_processes
+    from rstreams import RandomStreams
+    from sample import mh2_sample, nuts_sample
+    import distributions
+    R = RandomStreams(234)
+    mu = R.normal(0, 1)
+    nu = R.normal(0, 1)
+    x = R.normal(mu, 1, draw_shape=(3,))
+    y = R.normal(mu + nu, 1, draw_shape=(2,))
+    z = R.normal(nu, 1, draw_shape=(2,))
+    # w draws like z: the two have the same structure
+    w = R.normal(nu, 1, draw_shape=(2,))
+    observations = {x: numpy.ones(3), y: numpy.zeros(2), z: numpy.ones(2),
+            w: numpy.zeros(2)}
+    mh2_sample(R, [mu, nu], observations, cache_dir=cache_dir)(2, 1, 1)
+    nuts_sample(R, [mu, nu], observations, cache_dir=cache_dir)(2, 1, 1)
+
+def test_cache_across_processes():
+    d = tempfile.mkdtemp()
+    try:
+        # dict order follows object ids, which differ from one process to the
+        # next: the cache keys must not depend on it.  Every process allocates
+        # a different number of objects first, so that its ids differ.
+        code = ('import test_compiled; junk = [[] for i in range(%i)]; '
+                'test_compiled.build_samplers(%r)')
+        here = os.path.dirname(os.path.abspath(__file__))
+        subprocess.check_call([sys.executable, '-c', code % (0, d)], cwd=here)
+        files = sorted(os.listdir(d))
+        assert len(files) == 2
+        mtimes = [os.stat(os.path.join(d, f)).st_mtime for f in files]
+        for n in [1, 100, 1001, 5000]:
+            subprocess.check_call([sys.executable, '-c', code % (n, d)], cwd=here)
+            # a hit loads the cached functions and writes nothing
+            assert sorted(os.listdir(d)) == files
+            assert [os.stat(os.path.join(d, f)).st_mtime for f in files] == mtimes
+    finally:
+        shutil.rmtree(d)
+
+def test_no_cache_across_streams():
+    # an observation from another stream has no draw order shared with the
+    # model: the sampler is not cached
+    from rstreams import RandomStreams
+    from sample import mh2_sample
+    import distributions
+    d = tempfile.mkdtemp()
+    try:
+        R, R2 = RandomStreams(234), RandomStreams(235)
+        mu = R.normal(0, 1)
+        x = R2.normal(mu, 1, draw_shape=(3,))
+        mh2_sample(R, [mu], {x: numpy.ones(3)}, cache_dir=d)
+        assert os.listdir(d) == []
+    finally:
+        shutil.rmtree(d)
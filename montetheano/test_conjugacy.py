@@ -0,0 +1,90 @@
+import numpy
+import theano
+from theano import tensor
+from rstreams import RandomStreams
+import distributions
+from conjugacy import conjugate_update, collapse_dirichlet_multinomial
+from for_theano import ancestors
+from sample import gibbs_sample
+
+
+def test_detection():
+    R = RandomStreams(234)
+    m = R.normal(0, 1, draw_shape=(4,))
+    tau = R.gamma(2., 1., draw_shape=(4,))
+    x = R.normal(m, 1. / tensor.sqrt(tau), draw_shape=(4,))
+    RVs = [m, tau, x]
+    assert conjugate_update(m, [x], RVs) is not None
+    assert conjugate_update(tau, [x], RVs) is not None
+    # no children, nothing to condition on
+    assert conjugate_update(x, [], RVs) is None
+
+    # m also sets the scale of y
+    y = R.normal(m, tensor.exp(m), draw_shape=(4,))
+    assert conjugate_update(m, [y], [m, y]) is None
+    # a uniform prior has no registered posterior
+    u = R.uniform(0, 1, draw_shape=(4,))
+    z = R.normal(u, 1, draw_shape=(4,))
+    assert conjugate_update(u, [z], [u, z]) is None
+
+def test_dirichlet_categorical():
+    R = RandomStreams(234)
+    p = R.dirichlet(numpy.asarray([1., 1., 1.]))
+    c = R.categorical(p, draw_shape=(10,))
+    q = R.dirichlet(numpy.asarray([1., 1., 1.]))
+    d = R.categorical(q * 2, draw_shape=(10,))
+    assert conjugate_update(p, [c], [p, c]) is not None
+    assert conjugate_update(q, [d], [q, d]) is None
+
+def check_gibbs(R, rv, observations, mean, var):
+    # every draw of `rv` comes from its conjugate update, so the chain
+    # samples the analytic posterior
+    sampler = gibbs_sample(R, [rv], observations)
+    assert sampler.conjugate == [rv]
+    draws = sampler(2000, burnin=10, lag=1)[0]
+    assert numpy.all(abs(draws.mean(axis=0) - mean) < .1 * numpy.sqrt(var)), draws.mean(axis=0)
+    assert numpy.all(abs(draws.var(axis=0) / var - 1) < .15), draws.var(axis=0)
+
+def test_normal_normal_posterior():
+    R = RandomStreams(234)
+    m = R.normal(1., 2., draw_shape=(3,))
+    x = R.normal(m, .5, draw_shape=(3,))
+    x_data = numpy.asarray([0., 1., 2.])
+    precision = 1 / 4. + 4.
+    check_gibbs(R, m, {x: x_data}, (1 / 4. + 4 * x_data) / precision, 1 / precision)
+
+def test_gamma_normal_posterior():
+    R = RandomStreams(234)
+    tau = R.gamma(2., 1., draw_shape=(3,))
+    x = R.normal(0., 1. / tensor.sqrt(tau), draw_shape=(3,))
+    x_data = numpy.asarray([.5, 1., 2.])
+    k, theta = 2.5, 1. / (1. + x_data ** 2 / 2)
+    check_gibbs(R, tau, {x: x_data}, k * theta, k * theta ** 2)
+
+def test_dirichlet_categorical_posterior():
+    R = RandomStreams(234)
+    p = R.dirichlet(numpy.asarray([1., 1., 1.]))
+    c = R.categorical(p, draw_shape=(10,))
+    alpha = 1. + numpy.asarray([2., 3., 5.])
+    check_gibbs(R, p, {c: numpy.asarray([0, 0, 1, 1, 1, 2, 2, 2, 2, 2])},
+            alpha / 13, alpha * (13 - alpha) / (13 ** 2 * 14))
+
+def test_collapse_dirichlet_multinomial():
+    R = RandomStreams(234)
+    alpha = numpy.asarray([1., 2., 3.])
+    p = R.dirichlet(alpha)
+    obs = R.multinomial(theano.shared(numpy.asarray(20)), p, draw_shape=(2,))
+    new = R.multinomial(theano.shared(numpy.asarray(10)), p, draw_shape=(1,))
+    outputs, observations, collapsed = collapse_dirichlet_multinomial(
+            R, [new], {obs: numpy.asarray([[10, 5, 5], [10, 5, 5]])})
+    assert collapsed.keys() == [p]
+    assert p not in ancestors(outputs + observations.keys())
+
+    # the dirichlet is also an output: nothing to collapse
+    outputs, observations, collapsed = collapse_dirichlet_multinomial(R, [p, new])
+    assert collapsed == {} and outputs[0] is p
+
+    draws = numpy.asarray([theano.function([], R.DM(alpha, n=10, draw_shape=(4,)))()
+            for i in range(2)])
+    assert draws.shape == (2, 4, 3)
+    assert numpy.all(draws.sum(axis=2) == 10)
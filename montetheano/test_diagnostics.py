@@ -0,0 +1,52 @@
+import numpy
+from diagnostics import RunningMoments, ChainMonitor, split_rhat, ess
+
+
+def ar1(rng, phi, n, m):
+    x = numpy.empty((m, n))
+    x[:, 0] = rng.normal(size=m)
+    for t in range(1, n):
+        x[:, t] = phi * x[:, t - 1] + numpy.sqrt(1 - phi ** 2) * rng.normal(size=m)
+    return x
+
+def test_running_moments():
+    x = numpy.random.RandomState(1).normal(size=(100, 3))
+    r = RunningMoments()
+    for i in range(0, 100, 7):
+        r.update(x[i:i + 7])
+    assert numpy.allclose(r.mean, x.mean(axis=0))
+    assert numpy.allclose(r.variance(), x.var(axis=0, ddof=1))
+
+def test_rhat():
+    rng = numpy.random.RandomState(2)
+    x = rng.normal(size=(4, 1000))
+    assert abs(split_rhat(x) - 1) < 0.01
+    x[0] += 3
+    assert split_rhat(x) > 1.2
+
+def test_ess():
+    rng = numpy.random.RandomState(3)
+    assert 3000 < ess(rng.normal(size=(4, 1000))) < 5000
+    # for AR(1) the ESS is n (1 - phi) / (1 + phi)
+    e = ess(ar1(rng, 0.8, 5000, 4))
+    assert 1500 < e < 3000, e
+    # a constant element counts all its draws
+    x = numpy.concatenate([rng.normal(size=(2, 100, 1)), numpy.ones((2, 100, 1))], axis=2)
+    e = ess(x)
+    assert 100 < e[0] < 300 and e[1] == 200
+
+def test_monitor():
+    rng = numpy.random.RandomState(4)
+    x = ar1(rng, 0.5, 2000, 2)
+    monitor = ChainMonitor(window=500)
+    for i in range(0, 2000, 300):
+        for c in range(2):
+            monitor.update([x[c, i:i + 300], x[c, i:i + 300, None] * [1, 2]], chain=c)
+    assert monitor.count() == 4000
+    mean, mean2 = monitor.mean()
+    assert numpy.allclose(mean, x.mean())
+    assert mean2.shape == (2,)
+    assert numpy.allclose(monitor.variance()[0], x.var(ddof=1))
+    window = numpy.asarray([x[c, -500:] for c in range(2)])
+    assert numpy.allclose(monitor.rhat()[0], split_rhat(window))
+    assert numpy.allclose(monitor.ess()[0], ess(window) * 4)
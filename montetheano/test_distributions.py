@@ -1,5 +1,6 @@
 import unittest
 import numpy
+import scipy.stats
 
 import theano
 from theano import tensor
@@ -31,6 +32,50 @@ def test_multinomial():
     assert f().shape == (2, 5)
 
 
+def test_categorical_lpdf():
+    R = RandomStreams(234)
+    p = numpy.asarray([.2, .3, .5])
+    c = R.categorical(p, draw_shape=(4,))
+    f = theano.function([], lpdf(c, numpy.asarray([0, 1, 2, 2])))
+    assert numpy.allclose(f(), numpy.log([.2, .3, .5, .5]))
+
+def check_proposal(make_rv, mean, var):
+    # a chain that moves only by the local proposal of a single RV with no
+    # observations must leave its prior invariant
+    R = RandomStreams(234)
+    rv = make_rv(R)
+    draws = mh2_sample(R, [rv], sweep=True)(1000, burnin=100, lag=10)[0]
+    assert numpy.all(abs(draws.mean(axis=0) - mean) < .2 * numpy.sqrt(var)), draws.mean(axis=0)
+    assert numpy.all(abs(draws.var(axis=0) / var - 1) < .25), draws.var(axis=0)
+
+def test_uniform_proposal():
+    check_proposal(lambda R: R.uniform(2, 5, draw_shape=(3,)), 3.5, .75)
+
+def test_gamma_proposal():
+    check_proposal(lambda R: R.gamma(4., .5, draw_shape=(3,)), 2., 1.)
+
+def test_binomial_proposal():
+    n = theano.shared(numpy.asarray(4))
+    p = theano.shared(numpy.asarray(.3))
+    check_proposal(lambda R: R.binomial(n, p, draw_shape=(3,)), 1.2, .84)
+
+def test_categorical_proposal():
+    p = numpy.asarray([.2, .3, .5])
+    check_proposal(lambda R: R.categorical(p, draw_shape=(3,)), 1.3, .61)
+
+def test_dirichlet_proposal():
+    alpha = numpy.asarray([10., 20., 30.])
+    check_proposal(lambda R: R.dirichlet(alpha), alpha / 60,
+            alpha * (60 - alpha) / (60 ** 2 * 61))
+
+def test_binomial_lpdf():
+    R = RandomStreams(234)
+    b = R.binomial(theano.shared(numpy.asarray(4)), theano.shared(numpy.asarray(.3)),
+            draw_shape=(5,))
+    f = theano.function([], lpdf(b, numpy.asarray([0., 1., 2., 3., 4.])))
+    assert numpy.allclose(f(), scipy.stats.binom.logpmf(range(5), 4, .3))
+
+
 class TestBasicBinomial(unittest.TestCase):
     def setUp(self):
         s_rng = self.s_rng = RandomStreams(23424)
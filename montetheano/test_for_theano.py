@@ -63,3 +63,53 @@ def test_find():
     assert numpy.all(f([2, 1, 0, 4, 3], [4, 1]) == [1, 3])
     assert numpy.all(f([2, 1, 0, 4, 3], [1, 4]) == [1, 3])
     assert numpy.all(f([], [1, 4]) == [])
+
+def test_evaluate_cache():
+    sv = theano.shared(numpy.asarray([2., 3., 5.]))
+    for_theano.function_cache.clear()
+    assert numpy.allclose(for_theano.evaluate(sv * 2 + 1), [5, 7, 11])
+    # an identical graph, built again, is not compiled again
+    misses = for_theano.function_cache.misses
+    assert numpy.allclose(for_theano.evaluate(sv * 2 + 1), [5, 7, 11])
+    assert for_theano.function_cache.misses == misses
+    assert len(for_theano.function_cache) == 1
+    # a different constant or shared variable is a different graph
+    assert numpy.allclose(for_theano.evaluate(sv * 3 + 1), [7, 10, 16])
+    sv2 = theano.shared(numpy.asarray([1., 1., 1.]))
+    assert numpy.allclose(for_theano.evaluate(sv2 * 2 + 1), [3, 3, 3])
+    assert len(for_theano.function_cache) == 3
+    # the shared value is read when the function runs
+    sv.set_value(numpy.asarray([0., 0., 0.]))
+    assert numpy.allclose(for_theano.evaluate(sv * 2 + 1), [1, 1, 1])
+
+def test_lru_cache():
+    c = for_theano.LRUCache(2)
+    c['a'] = 1
+    c['b'] = 2
+    assert c.get('a') == 1
+    c['c'] = 3
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+
+def test_structural_hash():
+    def model(seed):
+        R = rstreams.RandomStreams(seed)
+        mu = R.normal(0, 10, draw_shape=(2,))
+        return R.normal(mu, tensor.exp(mu), draw_shape=(2,))
+    # the same model, built twice, with different random states
+    assert for_theano.structural_hash(model(1)) == for_theano.structural_hash(model(2))
+    sv = theano.shared(numpy.asarray([2., 3.]))
+    assert for_theano.structural_hash(sv + 1) != for_theano.structural_hash(sv + 2)
+    assert for_theano.structural_hash(sv + 1) != for_theano.structural_hash(sv * 1)
+
+def test_hash_cons():
+    R = rstreams.RandomStreams(234, hash_cons=True)
+    mu = R.normal(0, 1, draw_shape=(3,))
+    assert R.normal(0, 1, draw_shape=(3,)) is mu
+    assert R.normal(0, 2, draw_shape=(3,)) is not mu
+    # structurally identical arguments, built anew
+    x = R.normal(mu * 2, 1, draw_shape=(3,))
+    assert R.normal(mu * 2, 1, draw_shape=(3,)) is x
+    # without hash-consing every draw is new
+    R = rstreams.RandomStreams(234)
+    assert R.normal(0, 1, draw_shape=(3,)) is not R.normal(0, 1, draw_shape=(3,))
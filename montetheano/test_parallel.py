@@ -0,0 +1,44 @@
+import numpy
+import theano
+from theano import tensor
+from parallel import run_chains, random_states
+
+
+def fake_sampler(nr_samples, burnin = 100, lag = 1):
+    numpy.random.normal(size=burnin)
+    return [numpy.random.normal(size=(nr_samples, 3)),
+            numpy.random.randint(5, size=(nr_samples,))]
+
+def test_run_chains_shapes():
+    trace = run_chains(fake_sampler, 4, 10, processes=2)
+    assert trace[0].shape == (4, 10, 3)
+    assert trace[1].shape == (4, 10)
+    assert trace[1].dtype.kind == 'i'
+
+def test_run_chains_no_chains():
+    try:
+        run_chains(fake_sampler, 0, 10)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_run_chains_seed():
+    a = run_chains(fake_sampler, 3, 5, seed=1, processes=2)
+    b = run_chains(fake_sampler, 3, 5, seed=1, processes=3)
+    c = run_chains(fake_sampler, 3, 5, seed=2, processes=2)
+    assert numpy.all(a[0] == b[0])
+    assert not numpy.any(a[0] == c[0])
+    # chains are reseeded independently
+    assert not numpy.any(a[0][0] == a[0][1])
+
+def test_random_states():
+    R = tensor.shared_randomstreams.RandomStreams(234)
+    f = theano.function([], R.normal(size=(2,)))
+    def sampler(nr_samples, burnin = 100, lag = 1):
+        return [numpy.asarray([f() for i in range(nr_samples)])]
+    sampler.functions = [f]
+    assert len(random_states(sampler)) == 1
+    trace = run_chains(sampler, 2, 4, processes=2)
+    assert trace[0].shape == (2, 4, 2)
+    assert not numpy.any(trace[0][0] == trace[0][1])
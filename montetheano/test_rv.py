@@ -1,3 +1,5 @@
+import gc
+import weakref
 import unittest
 import numpy
 import theano
@@ -38,6 +40,104 @@ def test_dag_condition_bottom():
     f()
 
 
+def test_markov_blanket():
+    s_rng = RandomStreams(234)
+    mu = s_rng.normal(0, 1)
+    sigma = s_rng.uniform(low=.5, high=2)
+    x = s_rng.normal(mu, sigma, draw_shape=(4,))
+    y = s_rng.normal(2 * x, 1, draw_shape=(4,))
+    RVs = [mu, sigma, x, y]
+
+    assert set(rv.rv_parents(x, RVs)) == set([mu, sigma])
+    assert rv.rv_parents(y, RVs) == [x]
+    assert rv.rv_children(mu, RVs) == [x]
+    assert set(rv.markov_blanket(mu, RVs)) == set([x, sigma])
+    assert set(rv.markov_blanket(x, RVs)) == set([mu, sigma, y])
+    assert rv.local_factors(x, RVs) == [x, y]
+
+
+def test_graph_index():
+    s_rng = RandomStreams(234)
+    mu = s_rng.normal(0, 1, draw_shape=(4,))
+    sigma = s_rng.uniform(low=.5, high=2, draw_shape=(4,))
+    x = s_rng.normal(mu + 1, sigma, draw_shape=(4,))
+    index = rv.GraphIndex()
+    assert index.is_rv(x * 2)
+    assert not index.is_rv(tensor.constant(2) * 3)
+    assert index.nearest_rvs(x * 2) == (x,)
+    assert set(index.rv_parents(x)) == set([mu, sigma])
+    assert set(index.raw_rvs([x * 2])) == set([x, mu, sigma])
+    # the graph grows
+    y = s_rng.normal(2 * x, 1, draw_shape=(4,))
+    assert index.rv_parents(y) == [x]
+    assert set(index.raw_rvs([y])) == set([y, x, mu, sigma])
+    # x is not among the RVs: look through it
+    assert set(rv.rv_parents(y, [mu, sigma, y])) == set([mu, sigma])
+
+def test_graph_index_releases_graphs():
+    index = rv.GraphIndex()
+    refs = []
+    def query():
+        s_rng = RandomStreams(234)
+        mu = s_rng.normal(0, 1, draw_shape=(4,))
+        x = s_rng.normal(mu + 1, 1, draw_shape=(4,))
+        assert index.nearest_rvs(x) == (x,)
+        assert index.nearest_rvs(x * 2) == (x,)
+        assert index.raw_rvs([x * 2]) == [x, mu]
+        refs.extend([weakref.ref(mu), weakref.ref(x)])
+    query()
+    # entries go with their keys, which frees the RVs they hold, and so on
+    for i in range(3):
+        gc.collect()
+    assert [r() for r in refs] == [None, None]
+    # only theano's cached constants stay
+    for memo in [index.parents_memo, index.randomstate_memo]:
+        assert [v for v in memo.keys() if v.owner is not None] == []
+
+
+def test_log_likelihood_terms():
+    s_rng = RandomStreams(234)
+    mu = s_rng.normal(0, 1, draw_shape=(4,))
+    sigma = s_rng.uniform(low=.5, high=2, draw_shape=(4,))
+    x = s_rng.normal(mu + 1, sigma, draw_shape=(4,))
+    terms = rv.LogLikelihoodTerms([mu, sigma, x])
+    assert set(terms.depends[x]) == set([mu, sigma, x])
+    assert terms.depends[mu] == [mu]
+    assignment = {mu: numpy.asarray([.1, .2, .3, .4]),
+            sigma: numpy.asarray([1., 1.5, 1., .7]),
+            x: numpy.asarray([1., 0., 2., 1.])}
+    for factors in (None, [x], [mu, sigma]):
+        f = theano.function([], [rv.full_log_likelihood(dict(assignment), factors),
+            rv.full_log_likelihood(dict(assignment), factors, terms)])
+        a, b = f()
+        assert numpy.allclose(a, b), (factors, a, b)
+
+    # the terms of some RVs only, with placeholders for all of them: sigma
+    # keeps its assigned value instead of being drawn anew
+    terms = rv.LogLikelihoodTerms([mu, sigma, x], [x])
+    assert terms.factors == [x] and set(terms.depends[x]) == set([mu, sigma, x])
+    f = theano.function([], [rv.full_log_likelihood(dict(assignment), [x]),
+        rv.full_log_likelihood(dict(assignment), [x], terms)])
+    for i in range(3):
+        a, b = f()
+        assert numpy.allclose(a, b), (a, b)
+
+
+def test_color_classes():
+    s_rng = RandomStreams(234)
+    mu = s_rng.normal(0, 1, draw_shape=(2,))
+    thetas = [s_rng.normal(mu, 1, draw_shape=(2,)) for i in range(5)]
+    ys = [s_rng.normal(t, 1, draw_shape=(2,)) for t in thetas]
+    RVs = [mu] + thetas + ys
+    assert rv.color_classes([mu] + thetas, RVs) == [thetas, [mu]]
+    # observed children couple their parents
+    z = s_rng.normal(thetas[0] + thetas[1], 1, draw_shape=(2,))
+    classes = rv.color_classes([mu] + thetas, RVs + [z])
+    assert len(classes) == 3
+    for c in classes:
+        assert not (thetas[0] in c and thetas[1] in c)
+
+
 def test_normal_simple():
     s_rng = RandomStreams(23)
     n = s_rng.normal()
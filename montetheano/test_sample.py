@@ -0,0 +1,318 @@
+import time
+import numpy
+import theano
+from rstreams import RandomStreams
+import distributions
+from sample import mh_sample, mh2_sample, hybridmc_sample, hybridmc_adapt, nuts_sample
+from sample import as_sampler
+from diagnostics import ChainMonitor
+from for_theano import ancestors
+from rv import is_raw_rv
+from rstreams import rv_dist_name
+from sample import DualAveraging
+
+
+# mu ~ N(0, 1) and every row of x ~ N(mu, 1): the posterior of mu given the
+# rows of `data` is N(data.sum(0) / 5, 1 / 5)
+data = numpy.asarray([[1., 0.], [2., -1.], [1.5, 0.], [2.5, -.5]])
+posterior_mean = data.sum(axis=0) / 5
+posterior_var = .2
+
+def normal_model(seed = 234):
+    R = RandomStreams(seed)
+    mu = R.normal(0, 1, draw_shape=(2,))
+    x = R.normal(mu, 1, draw_shape=(4, 2))
+    return R, mu, x
+
+def check_moments(draws, tol = .15, mean = posterior_mean, var = posterior_var):
+    draws = numpy.asarray(draws)
+    assert numpy.all(abs(draws.mean(axis=0) - mean) < tol), draws.mean(axis=0)
+    assert numpy.all(abs(draws.var(axis=0) - var) < tol), draws.var(axis=0)
+
+
+def test_mh_sample_chains():
+    R = RandomStreams(234)
+    y_data = numpy.asarray([1., 2., 1.5, 2.5])
+    mu = R.normal(0, 1)
+    sigma = R.uniform(.5, 2)
+    y = R.normal(mu, sigma, draw_shape=(4,))
+    states, ll, updates = mh_sample(R, [mu, sigma], {y: y_data}, n_chains=5)
+    f = theano.function([], states + [ll], updates=updates)
+    trace = [f() for i in range(200)]
+    mus = numpy.asarray([t[0] for t in trace])
+    assert mus.shape == (200, 5)
+    assert trace[-1][1].shape == (5,) and trace[-1][2].shape == (5,)
+
+    # one log likelihood per chain
+    m, s, l = trace[-1]
+    expected = [-.5 * m[c] ** 2 - .5 * numpy.log(2 * numpy.pi) - numpy.log(1.5)
+            - .5 * numpy.sum(((y_data - m[c]) / s[c]) ** 2)
+            - 4 * numpy.log(numpy.sqrt(2 * numpy.pi) * s[c]) for c in range(5)]
+    assert numpy.allclose(l, expected)
+
+    # the chains move independently
+    steps = numpy.diff(mus, axis=0)
+    assert numpy.all(numpy.any(steps != 0, axis=0))
+    corr = numpy.corrcoef(steps.T)
+    assert numpy.all(abs(corr[numpy.triu_indices(5, 1)]) < .4)
+
+def test_hybridmc_sample():
+    R, mu, x = normal_model()
+    states, ll, updates = hybridmc_sample(R, [mu], {x: data}, n_leapfrog=3,
+            epsilon=.3, max_tries=1)
+    f = theano.function([], states, updates=updates)
+    draws = [f()[0] for i in range(300)]
+    check_moments(draws[50:])
+
+def test_dual_averaging():
+    # the acceptance statistic exp(-epsilon) reaches .65 at epsilon = -log(.65)
+    epsilon = theano.shared(numpy.asarray(.01))
+    adapt = DualAveraging(epsilon, target_accept=.65)
+    for i in range(2000):
+        adapt.update(numpy.exp(-epsilon.get_value()))
+    adapt.finalize()
+    assert abs(epsilon.get_value() + numpy.log(.65)) < .02, epsilon.get_value()
+
+def test_hybridmc_max_tries():
+    def moved(**kwargs):
+        R, mu, x = normal_model()
+        states, ll, updates = hybridmc_sample(R, [mu], {x: data},
+                n_leapfrog=3, **kwargs)
+        f = theano.function([], states, updates=updates)
+        draws = numpy.asarray([f()[0] for i in range(40)])
+        return numpy.any(numpy.diff(draws, axis=0) != 0, axis=1)
+
+    # by default every transition retries until a proposal is accepted
+    assert numpy.all(moved(epsilon=.3))
+    assert numpy.all(moved(epsilon=.8, max_tries=100))
+    # a single proposal at this step size is rejected about a third of the time
+    assert not numpy.all(moved(epsilon=.8, max_tries=1))
+
+def test_hybridmc_adapt():
+    R, mu, x = normal_model()
+    sampler, epsilon, inv_mass = hybridmc_adapt(R, [mu], {x: data},
+            n_leapfrog=3, n_warmup=300, target_accept=.65, epsilon=.01,
+            inv_mass={mu: 2.})
+    assert epsilon.get_value() > .1
+    # the posterior variance is .2 in both coordinates
+    assert numpy.all(abs(inv_mass[mu].get_value() - posterior_var) < .1)
+    draws = sampler(300, burnin=0)[0]
+    assert draws.shape == (300, 2)
+    check_moments(draws)
+    assert numpy.all(sampler(2, burnin=0, lag=0)[0] == draws[-1])
+
+    # single proposals with the adapted parameters are accepted roughly at
+    # the target rate (the averaged step size errs on the small side)
+    R, mu, x = normal_model(seed=235)
+    states, ll, updates = hybridmc_sample(R, [mu], {x: data}, n_leapfrog=3,
+            epsilon=epsilon, inv_mass={mu: inv_mass.values()[0]}, max_tries=1)
+    f = theano.function([], states, updates=updates)
+    draws = numpy.asarray([f()[0] for i in range(400)])
+    moved = numpy.any(numpy.diff(draws, axis=0) != 0, axis=1).mean()
+    assert .55 < moved < .95, moved
+
+def test_nuts_sample():
+    R, mu, x = normal_model()
+    sampler = nuts_sample(R, [mu], {x: data}, epsilon=.3)
+    draws = sampler(500, burnin=100)[0]
+    assert draws.shape == (500, 2)
+    check_moments(draws)
+    # one tree per transition, none of them diverging
+    assert len(sampler.stats['tree_depth']) == 600
+    assert 1 <= min(sampler.stats['tree_depth'])
+    assert not any(sampler.stats['diverging'])
+    # and only those of the latest call
+    sampler(20, burnin=0)
+    assert len(sampler.stats['tree_depth']) == len(sampler.stats['accept']) == 20
+
+    # far too large a step size
+    R, mu, x = normal_model()
+    sampler = nuts_sample(R, [mu], {x: data}, epsilon=20.)
+    sampler(20, burnin=0)
+    assert any(sampler.stats['diverging'])
+
+def test_mh2_sample_sweep():
+    R, mu, x = normal_model()
+    sampler = mh2_sample(R, [mu], {x: data}, sweep=True, n_sweeps=2)
+    draws = sampler(500, burnin=200, lag=5)[0]
+    assert draws.shape == (500, 2)
+    check_moments(draws)
+
+def test_as_sampler():
+    R, mu, x = normal_model()
+    states, ll, updates = hybridmc_sample(R, [mu], {x: data}, n_leapfrog=3,
+            epsilon=.3, max_tries=100)
+    sampler = as_sampler(states, updates)
+    draws = sampler(300, burnin=50)[0]
+    assert draws.shape == (300, 2)
+    check_moments(draws)
+
+    # lag 0 keeps the current state without a transition
+    draws = sampler(3, burnin=0, lag=0)[0]
+    assert numpy.all(draws == states[0].get_value())
+
+    # draws are squeezed like those of the other samplers
+    R = RandomStreams(234)
+    m = R.normal(0, 1, draw_shape=(1,))
+    y = R.normal(m, 1, draw_shape=(1,))
+    states, ll, updates = mh_sample(R, [m], {y: numpy.asarray([1.5])})
+    assert as_sampler(states, updates)(10, burnin=0)[0].shape == (10,)
+
+def lag1_autocorrelation(draws):
+    d = draws - draws.mean(axis=0)
+    return (d[1:] * d[:-1]).sum(axis=0) / (d * d).sum(axis=0)
+
+def test_mh2_sample_sweep_lag():
+    # burn-in and lag run inside the compiled sweep scan
+    R, mu, x = normal_model()
+    sampler = mh2_sample(R, [mu], {x: data}, sweep=True)
+    draws = sampler(400, burnin=100, lag=1)[0]
+    thinned = sampler(400, burnin=0, lag=20)[0]
+    assert draws.shape == thinned.shape == (400, 2)
+    check_moments(thinned)
+    assert numpy.all(lag1_autocorrelation(thinned) < .8)
+    assert numpy.all(lag1_autocorrelation(draws) > lag1_autocorrelation(thinned))
+    # lag=0 repeats the current state without running the scan
+    same = sampler(3, burnin=0, lag=0)[0]
+    assert numpy.all(same == thinned[-1])
+
+def test_mh2_sample_derived_outputs():
+    for sweep in [False, True]:
+        R, mu, x = normal_model()
+        sampler = mh2_sample(R, [mu, 2 * mu + 1, mu.sum()], {x: data},
+                sweep=sweep)
+        draws, derived, total = sampler(50, burnin=10, lag=2)
+        assert derived.shape == (50, 2) and total.shape == (50,)
+        assert numpy.allclose(derived, 2 * draws + 1)
+        assert numpy.allclose(total, draws.sum(axis=1))
+
+def test_mh2_sample_chunks():
+    R, mu, x = normal_model()
+    sampler = mh2_sample(R, [mu, mu.sum()], {x: data}, sweep=True)
+    chunks = list(sampler(25, burnin=10, lag=2, chunk_size=10))
+    assert [len(c[0]) for c in chunks] == [10, 10, 5]
+    assert [c[1].shape for c in chunks] == [(10,), (10,), (5,)]
+    draws = numpy.concatenate([c[0] for c in chunks])
+    assert draws.shape == (25, 2)
+    # the chunks continue the same chain
+    assert numpy.all(draws[-1] == sampler.state[0].get_value())
+
+def test_mh2_sample_early_stopping():
+    R, mu, x = normal_model()
+    sampler = mh2_sample(R, [mu], {x: data}, sweep=True)
+
+    # stops at the end of the first chunk with enough effective draws
+    monitor = ChainMonitor()
+    draws = sampler(None, burnin=50, lag=5, monitor=monitor,
+            target_ess=50)[0]
+    assert len(draws) % 100 == 0 and len(draws) == monitor.count()
+    assert numpy.all(monitor.ess()[0] >= 50)
+    check_moments(draws, tol=.25)
+
+    # nr_samples still bounds the run
+    assert len(sampler(150, burnin=0, lag=1, target_ess=1e9)[0]) == 150
+
+    # one target per output, None for an output that is not waited for
+    sampler = mh2_sample(R, [mu, mu.sum()], {x: data}, sweep=True)
+    monitor = ChainMonitor()
+    draws, total = sampler(None, burnin=50, lag=5, monitor=monitor,
+            target_ess=[30, 60])
+    assert numpy.all(monitor.ess()[0] >= 30) and monitor.ess()[1] >= 60
+    assert len(sampler(150, burnin=0, lag=1, target_ess=[None, 1e9])[0]) == 150
+    assert len(sampler(300, burnin=0, lag=1, target_ess=[1, None])[0]) == 100
+    try:
+        sampler(None, burnin=0, lag=1, target_ess=[50])
+        assert False
+    except ValueError:
+        pass
+
+    start = time.time()
+    draws = sampler(None, burnin=0, lag=1, max_seconds=.5)[0]
+    assert time.time() - start < 5
+    assert len(draws) and len(draws) % 100 == 0
+
+def test_adaptive_proposal_scale():
+    R, mu, x = normal_model()
+    sampler = mh2_sample(R, [mu], {x: data}, sweep=True, adaptive=True)
+    proposal = sampler.adaptive_proposals[mu]
+    draws = sampler(1000, burnin=1000, lag=1)[0]
+    # the scale grew from 0.1 until about 30% of the proposals are accepted,
+    # and stays fixed after burn-in
+    assert numpy.exp(proposal.log_scale.get_value()) > .3
+    accepted = numpy.any(numpy.diff(draws, axis=0) != 0, axis=1).mean()
+    assert abs(accepted - proposal.target_accept) < .07, accepted
+    assert proposal.adapting.get_value() == 0
+    check_moments(draws)
+
+def test_adaptive_proposal_covariance():
+    # mu[0] + mu[1] is well determined by y, their difference is not
+    R = RandomStreams(234)
+    mu = R.normal(0, 1, draw_shape=(2,))
+    y = R.normal(mu.sum(), .5, draw_shape=(5,))
+    cov = numpy.linalg.inv(numpy.eye(2) + 5 / .25 * numpy.ones((2, 2)))
+    sampler = mh2_sample(R, [mu], {y: numpy.asarray([1., 1.5, .5, 1., 1.2])},
+            sweep=True, adaptive=True, covariance=True)
+    draws = sampler(1000, burnin=2000, lag=1)[0]
+    proposal = sampler.adaptive_proposals[mu]
+    chol = proposal.chol.get_value()
+    learned = numpy.dot(chol, chol.T)
+    assert numpy.allclose(learned, cov, atol=.15), learned
+    assert learned[0, 1] / numpy.sqrt(learned[0, 0] * learned[1, 1]) < -.5
+    assert numpy.allclose(numpy.cov(draws.T), cov, atol=.1)
+
+def test_adaptive_proposal_per_sampler():
+    R, mu, x = normal_model()
+    adapted = mh2_sample(R, [mu], {x: data}, sweep=True, adaptive=True)
+    proposal = adapted.adaptive_proposals[mu]
+    scale = proposal.log_scale.get_value()
+    sampler = mh2_sample(R, [mu], {x: data}, sweep=True)
+    assert sampler.adaptive_proposals == {}
+    draws = sampler(500, burnin=200, lag=10)[0]
+    # a non-adaptive sampler on the same streams leaves the proposal of an
+    # adaptive one alone
+    assert proposal.log_scale.get_value() == scale
+    assert proposal.adapting.get_value() == 1
+    check_moments(draws)
+
+def test_mh2_sample_hash_cons():
+    R = RandomStreams(234, hash_cons=True)
+    a = R.normal(0, 1, draw_shape=(2,))
+    b = R.normal(1, 1, draw_shape=(2,))
+    assert R.normal(0, 1, draw_shape=(2,)) is a
+    consed = dict(R.consed)
+    sampler = mh2_sample(R, [a, b], sweep=True)
+    # the sampler's own draws bypass hash-consing ...
+    assert R.consed == consed and R.hash_cons
+    # ... so the two sites of a sweep draw independent acceptance thresholds
+    scan = [node.op for f in sampler.functions
+            for node in f.maker.fgraph.toposort()
+            if isinstance(node.op, theano.scan_module.scan_op.Scan)][0]
+    uniforms = [v for v in ancestors(scan.outputs) if is_raw_rv(v)
+            and v is v.owner.outputs[1] and rv_dist_name(v) == 'uniform']
+    assert len(uniforms) == 2
+
+def test_mh2_sample_observed_parent():
+    # sigma is observed: the lpdf of mu must use its value, not a new draw
+    R = RandomStreams(234)
+    sigma = R.uniform(.2, 2)
+    mu = R.normal(0, sigma, draw_shape=(2,))
+    x = R.normal(mu, 1, draw_shape=(4, 2))
+    sampler = mh2_sample(R, [mu], {sigma: .5, x: data}, sweep=True, n_sweeps=2)
+    draws = sampler(500, burnin=200, lag=5)[0]
+    # precision 1 / .5 ** 2 + 4
+    check_moments(draws, tol=.1, mean=data.sum(axis=0) / 8, var=1 / 8.)
+
+def test_mh2_sample_gibbs_parent():
+    # m is redrawn from its conjugate update and z by Metropolis-Hastings:
+    # the lpdf of z must use the current value of m
+    R = RandomStreams(234)
+    m = R.normal(0, 2, draw_shape=(2,))
+    z = R.normal(m, 1, draw_shape=(2,))
+    y = R.normal(2 * z, 1, draw_shape=(2,))
+    y_data = numpy.asarray([2., -1.])
+    sampler = mh2_sample(R, [z], {y: y_data}, sweep=True, n_sweeps=2,
+            conjugate=True)
+    assert sampler.conjugate == [m]
+    draws = sampler(500, burnin=200, lag=5)[0]
+    # z ~ N(0, 5) a priori, and 2z + N(0, 1) is observed
+    check_moments(draws, tol=.1, mean=2 * y_data / 4.2, var=1 / 4.2)
@@ -0,0 +1,43 @@
+import numpy
+from summaries import RunningCovariance, QuantileSketch, PosteriorSummary, summarize
+
+
+def test_covariance():
+    rng = numpy.random.RandomState(1)
+    x = numpy.dot(rng.normal(size=(500, 3)), rng.normal(size=(3, 3)))
+    a, b = RunningCovariance(), RunningCovariance()
+    for i in range(0, 300, 50):
+        a.update(x[i:i + 50])
+    b.update(x[300:])
+    a += b
+    assert numpy.allclose(a.mean, x.mean(axis=0))
+    assert numpy.allclose(a.covariance(), numpy.cov(x.T))
+
+def test_quantile_sketch():
+    rng = numpy.random.RandomState(2)
+    x = rng.normal(size=(20000, 2)) * [1, 10]
+    a, b = QuantileSketch(seed=1), QuantileSketch(seed=2)
+    for i in range(0, 10000, 100):
+        a.update(x[i:i + 100])
+        b.update(x[10000 + i:10100 + i])
+    a += b
+    assert a.count == 20000
+    assert sum([len(l) for l in a.levels]) < 1000
+    for q in [0.05, 0.5, 0.95]:
+        rank = (x < a.quantile(q)).mean(axis=0)
+        assert numpy.all(abs(rank - q) < 0.01), (q, rank)
+
+def test_summarize():
+    rng = numpy.random.RandomState(3)
+    x = rng.normal(size=(1000, 2))
+    def sampler(nr_samples, chunk_size):
+        return ([x[i:i + chunk_size], x[i:i + chunk_size, 0]]
+                for i in range(0, nr_samples, chunk_size))
+    s = summarize(sampler, 600, PosteriorSummary(covariance=True))
+    t = summarize(lambda n, chunk_size: [[x[600:], x[600:, 0]]], 400,
+            PosteriorSummary(covariance=True))
+    s += t
+    assert numpy.allclose(s.mean()[0], x.mean(axis=0))
+    assert numpy.allclose(s.variance()[1], x[:, 0].var(ddof=1))
+    assert numpy.allclose(s.cov()[0], numpy.cov(x.T))
+    assert s.quantile(0.5)[1].shape == ()
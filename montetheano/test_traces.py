@@ -0,0 +1,46 @@
+import shutil
+import tempfile
+import numpy
+from traces import TraceStore
+
+
+def test_append_read():
+    d = tempfile.mkdtemp()
+    try:
+        store = TraceStore(d, chunk_size=4)
+        a = numpy.random.normal(size=(10, 2, 3))
+        b = numpy.arange(10)
+        store.append([a[:3], b[:3]])
+        store.append([a[3:], b[3:]])
+        x, y = store.read()
+        assert isinstance(x, numpy.memmap)
+        assert x.shape == (10, 2, 3)
+        assert numpy.all(x == a)
+        assert numpy.all(y == b) and y.dtype == b.dtype
+        store.close()
+
+        # reopening appends
+        store = TraceStore(d)
+        assert len(store) == 10
+        store.append([a[:2], b[:2]])
+        x, y = store.read()
+        assert x.shape == (12, 2, 3)
+        assert numpy.all(x[10:] == a[:2])
+        store.close()
+    finally:
+        shutil.rmtree(d)
+
+def test_wrong_shape():
+    d = tempfile.mkdtemp()
+    try:
+        store = TraceStore(d)
+        store.append([numpy.zeros((2, 3))])
+        try:
+            store.append([numpy.zeros((2, 4))])
+        except ValueError:
+            pass
+        else:
+            assert False
+        store.close()
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,160 @@
+"""
+Append-only on-disk storage for MCMC traces.
+
+Every output gets one binary file in the store's directory.  The file starts
+with a fixed-size header giving the dtype, the shape of one draw and the
+number of draws written so far, followed by the draws in C order.  Space is
+preallocated `chunk_size` draws at a time, and the draws are read back as
+numpy.memmap views, so a trace never needs to fit in memory.
+"""
+import os
+import ast
+import numpy
+
+MAGIC = 'MTTRACE1'
+HEADER_SIZE = 256
+
+
+def _write_header(f, header):
+    text = MAGIC + repr(header)
+    if len(text) >= HEADER_SIZE:
+        raise ValueError('trace header too long', header)
+    f.seek(0)
+    f.write(text.ljust(HEADER_SIZE - 1) + '\n')
+
+def _read_header(f):
+    f.seek(0)
+    text = f.read(HEADER_SIZE)
+    if not text.startswith(MAGIC):
+        raise ValueError('not a trace file', f.name)
+    return ast.literal_eval(text[len(MAGIC):].strip())
+
+
+class TraceFile(object):
+    """
+    The draws of a single output.
+    """
+    def __init__(self, filename, chunk_size = 1000):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.header = None
+        if os.path.exists(filename):
+            self.f = open(filename, 'r+b')
+            self.header = _read_header(self.f)
+        else:
+            self.f = open(filename, 'w+b')
+
+    def _draw_bytes(self):
+        h = self.header
+        return numpy.dtype(h['dtype']).itemsize * int(numpy.prod(h['shape']))
+
+    def append(self, draws):
+        """
+        Append `draws`, an array with the draws along its first axis.
+        """
+        draws = numpy.asarray(draws)
+        if self.header is None:
+            self.header = dict(dtype=draws.dtype.str, shape=draws.shape[1:],
+                    count=0, capacity=0)
+        h = self.header
+        if draws.shape[1:] != h['shape']:
+            raise ValueError('draw shape does not match trace', draws.shape[1:], h['shape'])
+        draws = numpy.ascontiguousarray(draws, dtype=h['dtype'])
+        n = len(draws)
+        if h['count'] + n > h['capacity']:
+            n_chunks = (h['count'] + n - h['capacity'] + self.chunk_size - 1) // self.chunk_size
+            h['capacity'] += n_chunks * self.chunk_size
+            self.f.truncate(HEADER_SIZE + h['capacity'] * self._draw_bytes())
+        self.f.seek(HEADER_SIZE + h['count'] * self._draw_bytes())
+        self.f.write(draws.tobytes())
+        h['count'] += n
+        _write_header(self.f, h)
+        self.f.flush()
+
+    def truncate(self, count):
+        """
+        Forget the draws after the first `count`.
+        """
+        if self.header is not None and count < self.header['count']:
+            self.header['count'] = count
+            _write_header(self.f, self.header)
+            self.f.flush()
+
+    def read(self):
+        """
+        Return the draws written so far as a read-only numpy.memmap.
+        """
+        h = self.header
+        if h is None:
+            return numpy.empty((0,))
+        shape = (h['count'],) + tuple(h['shape'])
+        if h['count'] == 0 or self._draw_bytes() == 0:
+            return numpy.empty(shape, dtype=h['dtype'])
+        return numpy.memmap(self.filename, dtype=h['dtype'], mode='r',
+                offset=HEADER_SIZE, shape=shape)
+
+    def __len__(self):
+        if self.header is None:
+            return 0
+        return self.header['count']
+
+    def close(self):
+        self.f.close()
+
+
+class TraceStore(object):
+    """
+    One TraceFile per output, in `directory`.
+
+    Opening an existing store appends to it.  The samplers in sample.py take a
+    `store` argument; the draws are then appended chunk by chunk as they are
+    produced, and the sampler returns store.read().
+    """
+    def __init__(self, directory, chunk_size = 1000):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.files = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        k = 0
+        while os.path.exists(self._filename(k)):
+            self.files.append(TraceFile(self._filename(k), chunk_size))
+            k += 1
+
+    def _filename(self, k):
+        return os.path.join(self.directory, 'output%i.trace' % k)
+
+    def append(self, chunk):
+        """
+        Append a chunk of draws: one array per output, draws along the first axis.
+        """
+        if not self.files:
+            self.files = [TraceFile(self._filename(k), self.chunk_size)
+                    for k in range(len(chunk))]
+        if len(chunk) != len(self.files):
+            raise ValueError('wrong number of outputs', len(chunk), len(self.files))
+        for f, draws in zip(self.files, chunk):
+            f.append(draws)
+
+    def truncate(self, count):
+        """
+        Forget the draws after the first `count`, e.g. those written after the
+        last checkpoint.
+        """
+        for f in self.files:
+            f.truncate(count)
+
+    def read(self):
+        """
+        Return one numpy.memmap per output.
+        """
+        return [f.read() for f in self.files]
+
+    def __len__(self):
+        if not self.files:
+            return 0
+        return len(self.files[0])
+
+    def close(self):
+        for f in self.files:
+            f.close()